@@ -94,7 +94,10 @@ before_uninstall = "payments.utils.delete_custom_fields"
 # ---------------
 # Override standard doctype classes
 
-override_doctype_class = {"Web Form": "payments.overrides.payment_webform.PaymentWebForm"}
+override_doctype_class = {
+	"Integration Request": "payments.overrides.integration_request.PaymentsIntegrationRequest",
+	"Web Form": "payments.overrides.payment_webform.PaymentWebForm",
+}
 
 # Document Events
 # ---------------
@@ -114,6 +117,7 @@ override_doctype_class = {"Web Form": "payments.overrides.payment_webform.Paymen
 scheduler_events = {
 	"all": [
 		"payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.capture_payment",
+		"payments.payment_gateways.subscription_notifications.enqueue_notification_processing",
 	],
 }
 
@@ -0,0 +1,55 @@
+import frappe
+from frappe.integrations.doctype.integration_request.integration_request import (
+	IntegrationRequest,
+)
+
+from payments.utils.codec import PAYMENTS_SERVICES, decode_payload, encode_payload
+
+PAYLOAD_FIELDS = ("data", "output", "error")
+
+
+class PaymentsIntegrationRequest(IntegrationRequest):
+	"""Integration Request that stores the payloads of this app's gateways with the
+	payments codec; requests of other apps are left to the core implementation"""
+
+	def uses_codec(self):
+		return self.integration_request_service in PAYMENTS_SERVICES
+
+	def should_compress(self):
+		# handed to other apps' `handle_subscription_notification` hooks, keep plain JSON
+		return self.request_description != "Subscription Notification"
+
+	def before_insert(self):
+		if not self.uses_codec():
+			return
+
+		for fieldname in PAYLOAD_FIELDS:
+			self.set(fieldname, encode_payload(self.get(fieldname), self.should_compress()))
+
+	def update_status(self, params, status):
+		if not self.uses_codec():
+			return super().update_status(params, status)
+
+		data = decode_payload(self.data)
+		data.update(params)
+
+		self.data = encode_payload(data, self.should_compress())
+		self.status = status
+		self.save(ignore_permissions=True)
+		frappe.db.commit()
+
+	def handle_success(self, response):
+		"""update the output field with the response along with the relevant status"""
+		if not self.uses_codec():
+			return super().handle_success(response)
+
+		output = encode_payload(response, self.should_compress())
+		self.db_set({"status": "Completed", "output": output})
+
+	def handle_failure(self, response):
+		"""update the error field with the response along with the relevant status"""
+		if not self.uses_codec():
+			return super().handle_failure(response)
+
+		error = encode_payload(response, self.should_compress())
+		self.db_set({"status": "Failed", "error": error})
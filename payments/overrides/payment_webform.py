@@ -7,6 +7,8 @@ from frappe.utils import flt
 from frappe.website.doctype.web_form.web_form import WebForm
 
 from payments.utils import get_payment_gateway_controller
+from payments.utils.circuit_breaker import GatewayUnavailable, is_gateway_available
+from payments.utils.routing import is_routing_enabled, route_payment_gateway
 
 
 class PaymentWebForm(WebForm):
@@ -24,13 +26,33 @@ class PaymentWebForm(WebForm):
 
 	def get_payment_gateway_url(self, doc):
 		if getattr(self, "accept_payment", False):
-			controller = get_payment_gateway_controller(self.payment_gateway)
-
-			title = f"Payment for {doc.doctype} {doc.name}"
 			amount = self.amount
 			if self.amount_based_on_field:
 				amount = doc.get(self.amount_field)
 
+			payment_gateway = self.payment_gateway
+			if is_routing_enabled():
+				payment_gateway = route_payment_gateway(
+					amount,
+					self.currency,
+					default=payment_gateway,
+					reference_doctype=doc.doctype,
+					reference_docname=doc.name,
+				)
+
+			controller = get_payment_gateway_controller(payment_gateway)
+			gateway = controller.doctype.removesuffix(" Settings")
+			if not is_gateway_available(gateway, controller.name):
+				frappe.throw(
+					frappe._(
+						"{0} is not responding at the moment, please try again in a few minutes"
+					).format(gateway),
+					GatewayUnavailable,
+					title=frappe._("Something went wrong"),
+				)
+
+			title = f"Payment for {doc.doctype} {doc.name}"
+
 			from decimal import Decimal
 
 			if amount is None or Decimal(amount) <= 0:
@@ -0,0 +1,7 @@
+from payments.payment_gateways.doctype.gocardless_mandate.gocardless_mandate import (
+	add_customer_index,
+)
+
+
+def execute():
+	add_customer_index()
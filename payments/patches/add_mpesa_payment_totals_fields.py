@@ -0,0 +1,13 @@
+import frappe
+
+from payments.payment_gateways.doctype.mpesa_settings.mpesa_custom_fields import (
+	create_custom_pos_fields,
+)
+
+
+def execute():
+	# only sites that already use M-Pesa have the POS Invoice customisations
+	if "erpnext" not in frappe.get_installed_apps() or not frappe.db.count("Mpesa Settings"):
+		return
+
+	create_custom_pos_fields()
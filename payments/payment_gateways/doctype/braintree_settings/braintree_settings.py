@@ -10,7 +10,22 @@ from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, get_url
 
-from payments.utils import create_payment_gateway
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_reference_gateway_controller,
+	get_settings_cache,
+)
+from payments.utils.circuit_breaker import GatewayUnavailable, circuit_breaker
+from payments.utils.rate_limiter import acquire
+from payments.utils.transport import get_timeout
+
+# errors of the Braintree SDK counted as failed calls by the circuit breaker
+BRAINTREE_FAILURES = (
+	braintree.exceptions.ServerError,
+	braintree.exceptions.ServiceUnavailableError,
+	braintree.exceptions.TimeoutError,
+)
 
 
 class BraintreeSettings(Document):
@@ -163,18 +178,28 @@ class BraintreeSettings(Document):
 			controller=self.gateway_name,
 		)
 		call_hook_method("payment_gateway_enabled", gateway="Braintree-" + self.gateway_name)
+		clear_payment_gateway_cache(self)
+
+	def on_trash(self):
+		clear_payment_gateway_cache(self)
 
 	def configure_braintree(self):
+		"""Return a `BraintreeGateway` for these settings, leaving the global configuration alone"""
 		if self.use_sandbox:
 			environment = "sandbox"
 		else:
 			environment = "production"
 
-		braintree.Configuration.configure(
-			environment=environment,
-			merchant_id=self.merchant_id,
-			public_key=self.public_key,
-			private_key=self.get_password(fieldname="private_key", raise_exception=False),
+		connect_timeout, read_timeout = get_timeout("Braintree")
+
+		return braintree.BraintreeGateway(
+			braintree.Configuration(
+				environment=environment,
+				merchant_id=self.merchant_id,
+				public_key=self.public_key,
+				private_key=self.get_password(fieldname="private_key", raise_exception=False),
+				timeout=connect_timeout + read_timeout,
+			)
 		)
 
 	def validate_transaction_currency(self, currency):
@@ -195,8 +220,10 @@ class BraintreeSettings(Document):
 			self.integration_request = create_request_log(self.data, service_name="Braintree")
 			return self.create_charge_on_braintree()
 
-		except Exception:
-			frappe.log_error(frappe.get_traceback())
+		except Exception as e:
+			# the circuit is open, nothing new to log
+			if not isinstance(e, GatewayUnavailable):
+				frappe.log_error(frappe.get_traceback())
 			return {
 				"redirect_to": frappe.redirect_to_message(
 					_("Server Error"),
@@ -208,18 +235,20 @@ class BraintreeSettings(Document):
 			}
 
 	def create_charge_on_braintree(self):
-		self.configure_braintree()
+		gateway = get_braintree_gateway(self.name)
 
 		redirect_to = self.data.get("redirect_to") or None
 		redirect_message = self.data.get("redirect_message") or None
 
-		result = braintree.Transaction.sale(
-			{
-				"amount": self.data.amount,
-				"payment_method_nonce": self.data.payload_nonce,
-				"options": {"submit_for_settlement": True},
-			}
-		)
+		acquire("Braintree", gateway.config.merchant_id)
+		with circuit_breaker("Braintree", self.name, failures=BRAINTREE_FAILURES):
+			result = gateway.transaction.sale(
+				{
+					"amount": self.data.amount,
+					"payment_method_nonce": self.data.payload_nonce,
+					"options": {"submit_for_settlement": True},
+				}
+			)
 
 		if result.is_success:
 			self.integration_request.db_set("status", "Completed", update_modified=False)
@@ -276,16 +305,22 @@ class BraintreeSettings(Document):
 
 
 def get_gateway_controller(doc):
-	payment_request = frappe.get_doc("Payment Request", doc)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", payment_request.payment_gateway, "gateway_controller"
+	return get_reference_gateway_controller("Payment Request", doc)
+
+
+def get_braintree_gateway(gateway_controller):
+	"""Return the cached `BraintreeGateway` of a Braintree Settings, rebuilt when it is saved"""
+	return get_settings_cache(
+		"Braintree Settings",
+		gateway_controller,
+		"gateway",
+		lambda: frappe.get_doc("Braintree Settings", gateway_controller).configure_braintree(),
 	)
-	return gateway_controller
 
 
 def get_client_token(doc):
 	gateway_controller = get_gateway_controller(doc)
-	settings = frappe.get_doc("Braintree Settings", gateway_controller)
-	settings.configure_braintree()
+	gateway = get_braintree_gateway(gateway_controller)
 
-	return braintree.ClientToken.generate()
+	acquire("Braintree", gateway.config.merchant_id)
+	return gateway.client_token.generate()
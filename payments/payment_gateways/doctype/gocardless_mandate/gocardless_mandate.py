@@ -2,8 +2,15 @@
 # For license information, please see license.txt
 
 
+import frappe
 from frappe.model.document import Document
 
 
 class GoCardlessMandate(Document):
 	pass
+
+
+def add_customer_index():
+	"""Index the mandates of a customer, `customer` is a custom field added with ERPNext"""
+	if frappe.db.has_column("GoCardless Mandate", "customer"):
+		frappe.db.add_index("GoCardless Mandate", ["customer", "disabled"])
@@ -7,51 +7,97 @@ import hmac
 import json
 
 import frappe
+from frappe.query_builder import Case
+from frappe.utils import now
+
+from payments.utils import create_request_logs
+
+# mandates in these states can be charged, as statuses and as webhook actions
+ACTIVE_MANDATE_STATUSES = (
+	"pending_customer_approval",
+	"pending_submission",
+	"submitted",
+	"active",
+)
 
 
 @frappe.whitelist(allow_guest=True)
 def webhooks():
+	"""Apply a batch of GoCardless events.
+
+	Mandate events are reduced to the final state of each mandate and applied in one
+	UPDATE, which also refreshes the status that `check_mandate_validity` relies on, and
+	the events are logged as Integration Requests in one INSERT.
+	"""
 	r = frappe.request
 	if not r:
 		return
 
+	# before parsing anything from the body
 	if not authenticate_signature(r):
 		raise frappe.AuthenticationError
 
 	gocardless_events = json.loads(r.get_data()) or []
-	for event in gocardless_events["events"]:
-		set_status(event)
+	events = sorted(gocardless_events["events"], key=lambda event: event.get("created_at") or "")
+
+	set_mandate_statuses(get_mandate_statuses(events))
+	# named after the event id, so events of a retried webhook are only logged once
+	create_request_logs(
+		"GoCardless",
+		[
+			{
+				"name": event.get("id") or frappe.generate_hash(),
+				"status": "Completed",
+				"data": event,
+			}
+			for event in events
+		],
+	)
 
 	return 200
 
 
-def set_status(event):
-	resource_type = event.get("resource_type", {})
+def get_mandate_statuses(events):
+	"""Return the final status (action) of each mandate in the events, oldest events first"""
+	statuses = {}
+	for event in events:
+		if event.get("resource_type") != "mandates":
+			continue
 
-	if resource_type == "mandates":
-		set_mandate_status(event)
+		for mandate in get_event_mandates(event):
+			statuses[mandate] = event["action"]
 
+	return statuses
 
-def set_mandate_status(event):
-	mandates = []
+
+def get_event_mandates(event):
 	if isinstance(event["links"], (list,)):
-		for link in event["links"]:
-			mandates.append(link["mandate"])
-	else:
-		mandates.append(event["links"]["mandate"])
-
-	if (
-		event["action"] == "pending_customer_approval"
-		or event["action"] == "pending_submission"
-		or event["action"] == "submitted"
-		or event["action"] == "active"
-	):
-		disabled = 0
-	else:
-		disabled = 1
-
-	for mandate in mandates:
-		frappe.db.set_value("GoCardless Mandate", mandate, "disabled", disabled)
+		return [link["mandate"] for link in event["links"]]
+
+	return [event["links"]["mandate"]]
+
+
+def set_mandate_statuses(statuses):
+	if not statuses:
+		return
+
+	mandate = frappe.qb.DocType("GoCardless Mandate")
+	disabled, status = Case(), Case()
+	for name, value in statuses.items():
+		disabled = disabled.when(
+			mandate.name == name, 0 if value in ACTIVE_MANDATE_STATUSES else 1
+		)
+		status = status.when(mandate.name == name, value)
+
+	timestamp = now()
+	(
+		frappe.qb.update(mandate)
+		.set(mandate.disabled, disabled)
+		.set(mandate.status, status)
+		.set(mandate.status_updated_on, timestamp)
+		.set(mandate.modified, timestamp)
+		.where(mandate.name.isin(list(statuses)))
+	).run()
 
 
 def authenticate_signature(r):
@@ -9,7 +9,15 @@ import gocardless_pro
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, flt, get_url
+from frappe.utils import add_to_date, call_hook_method, cint, flt, get_url, now_datetime
+
+from payments.payment_gateways.doctype.gocardless_settings import ACTIVE_MANDATE_STATUSES
+from payments.utils import clear_payment_gateway_cache, get_reference_gateway_controller
+from payments.utils.rate_limiter import acquire
+
+
+# how long the mandate status received through webhooks is trusted, in seconds
+MANDATE_STATUS_TTL = 86400
 
 
 class GoCardlessSettings(Document):
@@ -35,6 +43,10 @@ class GoCardlessSettings(Document):
 			"GoCardless-" + self.gateway_name, settings="GoCardLess Settings", controller=self.gateway_name
 		)
 		call_hook_method("payment_gateway_enabled", gateway="GoCardless-" + self.gateway_name)
+		clear_payment_gateway_cache(self)
+
+	def on_trash(self):
+		clear_payment_gateway_cache(self)
 
 	def on_payment_request_submission(self, data):
 		if data.reference_doctype != "Fees":
@@ -64,23 +76,46 @@ class GoCardlessSettings(Document):
 			return True
 
 	def check_mandate_validity(self, data):
+		"""Return the usable mandate of the payer, if any.
+
+		The status kept up to date by the webhooks is trusted for
+		`gocardless_mandate_status_ttl` seconds (a day by default); the mandate is only
+		fetched from GoCardless when its status is older or not a usable one.
+		"""
+		registered_mandate = frappe.db.get_value(
+			"GoCardless Mandate",
+			dict(customer=data.get("payer_name"), disabled=0),
+			["mandate", "status", "status_updated_on"],
+			as_dict=True,
+		)
+		if not registered_mandate:
+			return None
 
-		if frappe.db.exists("GoCardless Mandate", dict(customer=data.get("payer_name"), disabled=0)):
-			registered_mandate = frappe.db.get_value(
-				"GoCardless Mandate", dict(customer=data.get("payer_name"), disabled=0), "mandate"
-			)
-			self.initialize_client()
-			mandate = self.client.mandates.get(registered_mandate)
+		ttl = cint(frappe.conf.gocardless_mandate_status_ttl) or MANDATE_STATUS_TTL
+		if (
+			registered_mandate.status in ACTIVE_MANDATE_STATUSES
+			and registered_mandate.status_updated_on
+			and registered_mandate.status_updated_on > add_to_date(now_datetime(), seconds=-ttl)
+		):
+			return {"mandate": registered_mandate.mandate}
 
-			if (
-				mandate.status == "pending_customer_approval"
-				or mandate.status == "pending_submission"
-				or mandate.status == "submitted"
-				or mandate.status == "active"
-			):
-				return {"mandate": registered_mandate}
-			else:
-				return None
+		self.initialize_client()
+		acquire("GoCardless", self.access_token)
+		mandate = self.client.mandates.get(registered_mandate.mandate)
+
+		frappe.db.set_value(
+			"GoCardless Mandate",
+			registered_mandate.mandate,
+			{
+				"status": mandate.status,
+				"status_updated_on": now_datetime(),
+				"disabled": 0 if mandate.status in ACTIVE_MANDATE_STATUSES else 1,
+			},
+			update_modified=False,
+		)
+
+		if mandate.status in ACTIVE_MANDATE_STATUSES:
+			return {"mandate": registered_mandate.mandate}
 		else:
 			return None
 
@@ -130,6 +165,7 @@ class GoCardlessSettings(Document):
 		self.initialize_client()
 
 		try:
+			acquire("GoCardless", self.access_token)
 			payment = self.client.payments.create(
 				params={
 					"amount": cint(reference_doc.grand_total * 100),
@@ -203,15 +239,14 @@ class GoCardlessSettings(Document):
 
 
 def get_gateway_controller(doc):
-	payment_request = frappe.get_doc("Payment Request", doc)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", payment_request.payment_gateway, "gateway_controller"
-	)
-	return gateway_controller
+	return get_reference_gateway_controller("Payment Request", doc)
 
 
 def gocardless_initialization(doc):
 	gateway_controller = get_gateway_controller(doc)
 	settings = frappe.get_doc("GoCardless Settings", gateway_controller)
 	client = settings.initialize_client()
+
+	# callers make one API call with the client
+	acquire("GoCardless", settings.access_token)
 	return client
@@ -1,8 +1,129 @@
 # Copyright (c) 2018, Frappe Technologies and Contributors
 # See license.txt
 
+import json
 import unittest
+from unittest.mock import MagicMock, patch
+
+import frappe
+from frappe.utils import add_to_date, now_datetime
+
+from payments.payment_gateways.doctype.gocardless_settings import webhooks
+
+PAYMENT_DATA = {"payer_name": "_Test GoCardless Customer"}
 
 
 class TestGoCardlessSettings(unittest.TestCase):
-	pass
+	def setUp(self):
+		patcher = patch(
+			"payments.payment_gateways.doctype.gocardless_settings.gocardless_settings.acquire"
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_out_of_order_webhook_batch(self):
+		create_mandate("MD_TEST_A")
+		create_mandate("MD_TEST_B")
+
+		events = [
+			get_mandate_event("EV_TEST_3", "MD_TEST_A", "cancelled", "2024-01-01T10:03:00.000Z"),
+			get_mandate_event("EV_TEST_4", "MD_TEST_B", "active", "2024-01-01T10:04:00.000Z"),
+			get_mandate_event("EV_TEST_1", "MD_TEST_A", "active", "2024-01-01T10:01:00.000Z"),
+			get_mandate_event("EV_TEST_2", "MD_TEST_B", "cancelled", "2024-01-01T10:02:00.000Z"),
+			{
+				"id": "EV_TEST_5",
+				"created_at": "2024-01-01T10:05:00.000Z",
+				"resource_type": "payments",
+				"action": "confirmed",
+				"links": {"payment": "PM_TEST", "mandate": "MD_TEST_A"},
+			},
+		]
+		post_webhook({"events": events})
+
+		# the latest mandate event wins, whatever the order of the batch
+		self.assertEqual(get_mandate_state("MD_TEST_A"), {"disabled": 1, "status": "cancelled"})
+		self.assertEqual(get_mandate_state("MD_TEST_B"), {"disabled": 0, "status": "active"})
+		# every event is logged
+		for event in events:
+			self.assertTrue(frappe.db.exists("Integration Request", event["id"]))
+
+	def test_fresh_active_mandate_is_not_fetched(self):
+		create_mandate("MD_TEST_A")
+
+		settings, client = get_settings("active")
+		self.assertEqual(settings.check_mandate_validity(PAYMENT_DATA), {"mandate": "MD_TEST_A"})
+		client.mandates.get.assert_not_called()
+
+	def test_stale_mandate_is_fetched(self):
+		create_mandate("MD_TEST_A", status_updated_on=add_to_date(now_datetime(), days=-2))
+
+		settings, client = get_settings("active")
+		self.assertEqual(settings.check_mandate_validity(PAYMENT_DATA), {"mandate": "MD_TEST_A"})
+		client.mandates.get.assert_called_once_with("MD_TEST_A")
+
+		# trusted again until the TTL runs out
+		self.assertGreater(
+			frappe.db.get_value("GoCardless Mandate", "MD_TEST_A", "status_updated_on"),
+			add_to_date(now_datetime(), minutes=-1),
+		)
+
+	def test_inactive_mandate_is_fetched(self):
+		create_mandate("MD_TEST_A", status="created")
+
+		settings, client = get_settings("cancelled")
+		self.assertIsNone(settings.check_mandate_validity(PAYMENT_DATA))
+		client.mandates.get.assert_called_once_with("MD_TEST_A")
+		self.assertEqual(get_mandate_state("MD_TEST_A"), {"disabled": 1, "status": "cancelled"})
+
+
+def get_settings(mandate_status):
+	"""Return unsaved GoCardless Settings and their mocked client, which answers every
+	mandate lookup with `mandate_status`"""
+	settings = frappe.get_doc(
+		{"doctype": "GoCardless Settings", "gateway_name": "_Test", "access_token": "test"}
+	)
+	settings.client = MagicMock()
+	settings.client.mandates.get.return_value = frappe._dict(status=mandate_status)
+	settings.initialize_client = MagicMock(return_value=settings.client)
+	return settings, settings.client
+
+
+def create_mandate(mandate, status="active", status_updated_on=None):
+	return frappe.get_doc(
+		{
+			"doctype": "GoCardless Mandate",
+			"mandate": mandate,
+			"gocardless_customer": "CU_TEST",
+			"customer": PAYMENT_DATA["payer_name"],
+			"status": status,
+			"status_updated_on": status_updated_on or now_datetime(),
+		}
+	).insert(ignore_permissions=True, ignore_links=True)
+
+
+def get_mandate_event(event_id, mandate, action, created_at):
+	return {
+		"id": event_id,
+		"created_at": created_at,
+		"resource_type": "mandates",
+		"action": action,
+		"links": {"mandate": mandate},
+	}
+
+
+def get_mandate_state(mandate):
+	return frappe.db.get_value("GoCardless Mandate", mandate, ["disabled", "status"], as_dict=True)
+
+
+def post_webhook(payload):
+	request = MagicMock()
+	request.get_data.return_value = json.dumps(payload).encode()
+
+	with patch.object(frappe.local, "request", request, create=True), patch(
+		"payments.payment_gateways.doctype.gocardless_settings.authenticate_signature",
+		return_value=True,
+	):
+		return webhooks()
@@ -13,16 +13,26 @@ class MpesaConnector:
 		app_secret=None,
 		sandbox_url="https://sandbox.safaricom.co.ke",
 		live_url="https://api.safaricom.co.ke",
+		access_token=None,
+		session=None,
+		timeout=None,
 	):
-		"""Setup configuration for Mpesa connector and generate new access token."""
+		"""Setup configuration for Mpesa connector and generate new access token if none is given."""
 		self.env = env
 		self.app_key = app_key
 		self.app_secret = app_secret
+		self.session = session or requests
+		self.timeout = timeout
+		self.token_expires_in = None
 		if env == "sandbox":
 			self.base_url = sandbox_url
 		else:
 			self.base_url = live_url
-		self.authenticate()
+
+		if access_token:
+			self.authentication_token = access_token
+		else:
+			self.authenticate()
 
 	def authenticate(self):
 		"""
@@ -33,9 +43,15 @@ class MpesaConnector:
 		"""
 		authenticate_uri = "/oauth/v1/generate?grant_type=client_credentials"
 		authenticate_url = f"{self.base_url}{authenticate_uri}"
-		r = requests.get(authenticate_url, auth=HTTPBasicAuth(self.app_key, self.app_secret))
-		self.authentication_token = r.json()["access_token"]
-		return r.json()["access_token"]
+		r = self.session.get(
+			authenticate_url,
+			auth=HTTPBasicAuth(self.app_key, self.app_secret),
+			timeout=self.timeout,
+		)
+		response = r.json()
+		self.authentication_token = response["access_token"]
+		self.token_expires_in = int(response.get("expires_in") or 0) or None
+		return self.authentication_token
 
 	def get_balance(
 		self,
@@ -81,7 +97,7 @@ class MpesaConnector:
 			"Content-Type": "application/json",
 		}
 		saf_url = "{}{}".format(self.base_url, "/mpesa/accountbalance/v1/query")
-		r = requests.post(saf_url, headers=headers, json=payload)
+		r = self.session.post(saf_url, headers=headers, json=payload, timeout=self.timeout)
 		return r.json()
 
 	def stk_push(
@@ -145,5 +161,5 @@ class MpesaConnector:
 		}
 
 		saf_url = "{}{}".format(self.base_url, "/mpesa/stkpush/v1/processrequest")
-		r = requests.post(saf_url, headers=headers, json=payload)
+		r = self.session.post(saf_url, headers=headers, json=payload, timeout=self.timeout)
 		return r.json()
@@ -3,7 +3,7 @@ from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
 
 def create_custom_pos_fields():
-	"""Create custom fields corresponding to POS Settings and POS Invoice."""
+	"""Create custom fields corresponding to POS Settings, POS Invoice and Payment Request."""
 	pos_field = {
 		"POS Invoice": [
 			{
@@ -25,6 +25,42 @@ def create_custom_pos_fields():
 	if not frappe.get_meta("POS Invoice").has_field("request_for_payment"):
 		create_custom_fields(pos_field)
 
+	# running totals of split requests, updated by each payment callback
+	payment_request_field = {
+		"Payment Request": [
+			{
+				"fieldname": "mpesa_amount_paid",
+				"label": "Mpesa Amount Paid",
+				"fieldtype": "Currency",
+				"options": "currency",
+				"read_only": 1,
+				"hidden": 1,
+				"no_copy": 1,
+				"insert_after": "grand_total",
+			},
+			{
+				"fieldname": "mpesa_request_count",
+				"label": "Mpesa Request Count",
+				"fieldtype": "Int",
+				"read_only": 1,
+				"hidden": 1,
+				"no_copy": 1,
+				"insert_after": "mpesa_amount_paid",
+			},
+			{
+				"fieldname": "mpesa_receipts",
+				"label": "Mpesa Receipts",
+				"fieldtype": "Small Text",
+				"read_only": 1,
+				"hidden": 1,
+				"no_copy": 1,
+				"insert_after": "mpesa_request_count",
+			},
+		]
+	}
+	if not frappe.get_meta("Payment Request").has_field("mpesa_amount_paid"):
+		create_custom_fields(payment_request_field)
+
 	record_dict = [
 		{
 			"doctype": "POS Field",
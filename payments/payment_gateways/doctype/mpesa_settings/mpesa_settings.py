@@ -2,19 +2,50 @@
 # For license information, please see license.txt
 
 
-from json import dumps, loads
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from json import dumps
 
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, fmt_money, get_request_site_address
+from frappe.utils import call_hook_method, cint, flt, fmt_money, get_request_site_address
+from redis.exceptions import LockError
 
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_connector import MpesaConnector
 from payments.payment_gateways.doctype.mpesa_settings.mpesa_custom_fields import (
 	create_custom_pos_fields,
 )
-from payments.utils import erpnext_app_import_guard
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_request_logs,
+	erpnext_app_import_guard,
+)
+from payments.utils.circuit_breaker import (
+	GatewayUnavailable,
+	circuit_breaker,
+	get_circuit_breaker,
+)
+from payments.utils.codec import decode_payload
+from payments.utils.secret_cache import get_doc_password
+from payments.utils.transport import get_session, get_timeout
+
+
+# Safaricom issues tokens valid for an hour; refresh a minute early
+ACCESS_TOKEN_DEFAULT_EXPIRY = 3599
+ACCESS_TOKEN_EXPIRY_MARGIN = 60
+ACCESS_TOKEN_REFRESH_TIMEOUT = 10
+# error codes of requests made with an expired or revoked access token
+INVALID_ACCESS_TOKEN_ERRORS = ("404.001.03", "401.003.01")
+
+# concurrent STK pushes per payment request, overridden by `mpesa_stk_push_fanout`
+STK_PUSH_FANOUT = 4
+
+MPESA_URLS = {
+	"sandbox": "https://sandbox.safaricom.co.ke",
+	"production": "https://api.safaricom.co.ke",
+}
 
 
 class MpesaSettings(Document):
@@ -46,23 +77,84 @@ class MpesaSettings(Document):
 		# required to fetch the bank account details from the payment gateway account
 		frappe.db.commit()  # nosemgrep
 		create_mode_of_payment("Mpesa-" + self.payment_gateway_name, payment_type="Phone")
+		clear_payment_gateway_cache(self)
+		clear_access_token_cache(self)
+
+	def on_trash(self):
+		clear_payment_gateway_cache(self)
 
 	def request_for_payment(self, **kwargs):
+		"""Send one STK push per chunk of the requested amount.
+
+		Settings, the access token and the passkey are loaded once, and chunks are sent
+		concurrently (`mpesa_stk_push_fanout` in site config, 1 sends them one by one).
+		Each chunk result is published to the user as it arrives, and all Integration
+		Requests are logged together once every chunk has been sent.
+		"""
 		args = frappe._dict(kwargs)
 		request_amounts = self.split_request_amount_according_to_transaction_limit(args)
 
-		for i, amount in enumerate(request_amounts):
-			args.request_amount = amount
-			if frappe.flags.in_test:
-				from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
-					get_payment_request_response_payload,
-				)
+		if frappe.flags.in_test:
+			from payments.payment_gateways.doctype.mpesa_settings.test_mpesa_settings import (
+				get_payment_request_response_payload as send_stk_push,
+			)
+		else:
+			send_stk_push = get_stk_push_sender(self, args.sender)
+
+		fanout = cint(frappe.conf.get("mpesa_stk_push_fanout")) or STK_PUSH_FANOUT
+		chunks = len(request_amounts)
+		logs, errors = [], []
+
+		with ThreadPoolExecutor(max_workers=min(fanout, chunks)) as executor:
+			futures = {
+				executor.submit(send_stk_push, amount): (i, amount)
+				for i, amount in enumerate(request_amounts)
+			}
+			for future in as_completed(futures):
+				i, amount = futures[future]
+				request_dict = frappe._dict(args, request_amount=amount)
+
+				try:
+					response = frappe._dict(future.result())
+				except Exception as e:
+					if not isinstance(e, GatewayUnavailable):
+						frappe.log_error("Mpesa Express Transaction Error")
+					errors.append(
+						_(
+							"Issue detected with Mpesa configuration, check the error logs for more details"
+						)
+					)
+					self.publish_stk_push_status(args, i, chunks, amount, "Failed")
+					continue
+
+				log, error = self.get_api_response_log("CheckoutRequestID", request_dict, response)
+				logs.append(log)
+				if error:
+					errors.append(_(response.errorMessage))
+
+				status = "Failed" if error else "Requested"
+				self.publish_stk_push_status(args, i, chunks, amount, status)
+
+		create_request_logs("Mpesa", logs)
+		# callbacks look the logs up from another request, make them visible right away
+		frappe.db.commit()  # nosemgrep
 
-				response = frappe._dict(get_payment_request_response_payload(amount))
-			else:
-				response = frappe._dict(generate_stk_push(**args))
+		if errors:
+			frappe.throw(errors[0], title=_("Transaction Error"))
 
-			self.handle_api_response("CheckoutRequestID", args, response)
+	def publish_stk_push_status(self, args, index, count, amount, status):
+		frappe.publish_realtime(
+			"mpesa_stk_push_status",
+			{
+				"reference_doctype": args.reference_doctype,
+				"reference_docname": args.reference_docname,
+				"chunk": index + 1,
+				"chunks": count,
+				"amount": amount,
+				"status": status,
+			},
+			user=frappe.session.user,
+		)
 
 	def split_request_amount_according_to_transaction_limit(self, args):
 		request_amount = args.request_amount
@@ -101,6 +193,15 @@ class MpesaSettings(Document):
 
 		self.handle_api_response("ConversationID", payload, response)
 
+	def get_api_response_log(self, global_id, request_dict, response):
+		"""Return the Integration Request log for an API response and its error, if any."""
+		if response.get("requestId"):
+			return dict(name=response.requestId, data=request_dict, error=response), response
+
+		# global checkout id used as request name, callbacks can't match a log without one
+		name = response.get(global_id) or frappe.generate_hash(length=10)
+		return dict(name=name, data=request_dict), None
+
 	def handle_api_response(self, global_id, request_dict, response):
 		"""Response received from API calls returns a global identifier for each transaction, this code is returned during the callback."""
 		# check error response
@@ -119,6 +220,60 @@ class MpesaSettings(Document):
 			frappe.throw(_(getattr(response, "errorMessage")), title=_("Transaction Error"))
 
 
+def get_stk_push_sender(mpesa_settings, sender):
+	"""Return a thread-safe `send(amount)` that pushes a payment prompt to `sender`.
+
+	Everything that touches the database (settings, secrets, the access token and the
+	site address) is resolved here, so the returned function can run in worker threads.
+	"""
+	callback_url = (
+		get_request_site_address(True)
+		+ "/api/method/payments.payment_gateways.doctype.mpesa_settings.mpesa_settings.verify_transaction"
+	)
+	env = get_environment(mpesa_settings)
+	# for sandbox, business shortcode is same as till number
+	business_shortcode = (
+		mpesa_settings.business_shortcode if env == "production" else mpesa_settings.till_number
+	)
+	passcode = get_doc_password(mpesa_settings, "online_passkey")
+	mobile_number = sanitize_mobile_number(sender)
+	connector = get_mpesa_connector(mpesa_settings)
+	# lets the connector authenticate again if M-Pesa rejects the cached token
+	connector.app_secret = get_doc_password(mpesa_settings, "consumer_secret")
+	breaker = get_circuit_breaker("Mpesa", mpesa_settings.name)
+	redis = frappe.cache()
+	token_cache_key = redis.make_key(get_access_token_cache_key(mpesa_settings))
+	refresh_lock = threading.Lock()
+
+	def push(amount):
+		with breaker.guard():
+			return connector.stk_push(
+				business_shortcode=business_shortcode,
+				amount=amount,
+				passcode=passcode,
+				callback_url=callback_url,
+				reference_code=mpesa_settings.till_number,
+				phone_number=mobile_number,
+				description="POS Payment",
+			)
+
+	def send(amount):
+		token = connector.authentication_token
+		response = push(amount)
+		if not is_invalid_access_token(response):
+			return response
+
+		with refresh_lock:
+			# the first chunk to get rejected fetches a new token for all of them
+			if connector.authentication_token == token:
+				redis.delete(token_cache_key)
+				connector.authenticate()
+
+		return push(amount)
+
+	return send
+
+
 def generate_stk_push(**kwargs):
 	"""Generate stk push by making a API call to the stk push API."""
 	args = frappe._dict(kwargs)
@@ -129,40 +284,142 @@ def generate_stk_push(**kwargs):
 		)
 
 		mpesa_settings = frappe.get_doc("Mpesa Settings", args.payment_gateway[6:])
-		env = "production" if not mpesa_settings.sandbox else "sandbox"
+		env = get_environment(mpesa_settings)
 		# for sandbox, business shortcode is same as till number
 		business_shortcode = (
 			mpesa_settings.business_shortcode if env == "production" else mpesa_settings.till_number
 		)
 
-		connector = MpesaConnector(
-			env=env,
-			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
-		)
+		connector = get_mpesa_connector(mpesa_settings)
 
 		mobile_number = sanitize_mobile_number(args.sender)
 
-		response = connector.stk_push(
-			business_shortcode=business_shortcode,
-			amount=args.request_amount,
-			passcode=mpesa_settings.get_password("online_passkey"),
-			callback_url=callback_url,
-			reference_code=mpesa_settings.till_number,
-			phone_number=mobile_number,
-			description="POS Payment",
-		)
+		passcode = get_doc_password(mpesa_settings, "online_passkey")
+
+		with circuit_breaker("Mpesa", mpesa_settings.name):
+			response = call_with_access_token(
+				mpesa_settings,
+				connector.stk_push,
+				business_shortcode=business_shortcode,
+				amount=args.request_amount,
+				passcode=passcode,
+				callback_url=callback_url,
+				reference_code=mpesa_settings.till_number,
+				phone_number=mobile_number,
+				description="POS Payment",
+			)
 
 		return response
 
-	except Exception:
-		frappe.log_error("Mpesa Express Transaction Error")
+	except Exception as e:
+		# the circuit is open, nothing new to log
+		if not isinstance(e, GatewayUnavailable):
+			frappe.log_error("Mpesa Express Transaction Error")
 		frappe.throw(
 			_("Issue detected with Mpesa configuration, check the error logs for more details"),
 			title=_("Mpesa Express Error"),
 		)
 
 
+def get_environment(mpesa_settings):
+	return "production" if not mpesa_settings.sandbox else "sandbox"
+
+
+def get_mpesa_connector(mpesa_settings):
+	"""Return a connector authenticated with the shared, cached access token."""
+	return MpesaConnector(
+		env=get_environment(mpesa_settings),
+		app_key=mpesa_settings.consumer_key,
+		access_token=get_access_token(mpesa_settings),
+		**get_transport_options(mpesa_settings),
+	)
+
+
+def get_transport_options(mpesa_settings):
+	base_url = MPESA_URLS[get_environment(mpesa_settings)]
+	return {"session": get_session("Mpesa", base_url), "timeout": get_timeout("Mpesa")}
+
+
+def get_access_token(mpesa_settings):
+	"""
+	Return an OAuth access token for the settings' credentials.
+
+	Tokens are cached in Redis per (environment, consumer key) until shortly before
+	they expire. Refreshing is single-flight: one worker fetches a new token while
+	holding a lock, the others wait for it and reuse the cached value.
+	"""
+	cache_key = get_access_token_cache_key(mpesa_settings)
+	access_token = frappe.cache().get_value(cache_key, expires=True)
+	if access_token:
+		return access_token
+
+	lock = frappe.cache().lock(
+		frappe.cache().make_key(f"{cache_key}|refresh"),
+		timeout=ACCESS_TOKEN_REFRESH_TIMEOUT,
+		blocking_timeout=ACCESS_TOKEN_REFRESH_TIMEOUT,
+	)
+
+	try:
+		with lock:
+			# another worker may have refreshed the token while we waited for the lock
+			access_token = frappe.cache().get_value(cache_key, expires=True)
+			if not access_token:
+				access_token = refresh_access_token(mpesa_settings, cache_key)
+	except LockError:
+		# lock holder is stuck, don't make the cashier wait for it
+		access_token = refresh_access_token(mpesa_settings, cache_key)
+
+	return access_token
+
+
+def refresh_access_token(mpesa_settings, cache_key):
+	connector = MpesaConnector(
+		env=get_environment(mpesa_settings),
+		app_key=mpesa_settings.consumer_key,
+		app_secret=get_doc_password(mpesa_settings, "consumer_secret"),
+		**get_transport_options(mpesa_settings),
+	)
+
+	expires_in = connector.token_expires_in or ACCESS_TOKEN_DEFAULT_EXPIRY
+	if expires_in > ACCESS_TOKEN_EXPIRY_MARGIN:
+		frappe.cache().set_value(
+			cache_key,
+			connector.authentication_token,
+			expires_in_sec=expires_in - ACCESS_TOKEN_EXPIRY_MARGIN,
+		)
+
+	return connector.authentication_token
+
+
+def call_with_access_token(mpesa_settings, method, **kwargs):
+	"""Call a method of an `MpesaConnector`, and once more with a new access token if
+	M-Pesa rejects the cached one, e.g. because it was revoked"""
+	response = method(**kwargs)
+	if not is_invalid_access_token(response):
+		return response
+
+	clear_access_token_cache(mpesa_settings)
+	method.__self__.authentication_token = get_access_token(mpesa_settings)
+	return method(**kwargs)
+
+
+def is_invalid_access_token(response):
+	if not isinstance(response, dict):
+		return False
+
+	return str(response.get("errorCode")) in INVALID_ACCESS_TOKEN_ERRORS or (
+		"invalid access token" in str(response.get("errorMessage") or "").lower()
+	)
+
+
+def get_access_token_cache_key(mpesa_settings):
+	return f"mpesa_access_token|{get_environment(mpesa_settings)}|{mpesa_settings.consumer_key}"
+
+
+def clear_access_token_cache(mpesa_settings):
+	frappe.cache().delete_value(get_access_token_cache_key(mpesa_settings))
+
+
 def sanitize_mobile_number(number):
 	"""Add country code and strip leading zeroes from the phone number."""
 	return "254" + str(number).lstrip("0")
@@ -178,12 +435,13 @@ def verify_transaction(**kwargs):
 		frappe.throw(_("Invalid Checkout Request ID"))
 
 	integration_request = frappe.get_doc("Integration Request", checkout_id)
-	transaction_data = frappe._dict(loads(integration_request.data))
+	transaction_data = decode_payload(integration_request.data)
 	total_paid = 0  # for multiple integration request made against a pos invoice
 	success = False  # for reporting successfull callback to point of sale ui
 
 	if transaction_response["ResultCode"] == 0:
 		if integration_request.reference_doctype and integration_request.reference_docname:
+			frappe.db.savepoint("mpesa_verify_transaction")
 			try:
 				item_response = transaction_response["CallbackMetadata"]["Item"]
 				amount = fetch_param_value(item_response, "Amount", "Name")
@@ -192,13 +450,10 @@ def verify_transaction(**kwargs):
 					integration_request.reference_doctype, integration_request.reference_docname
 				)
 
-				mpesa_receipts, completed_payments = get_completed_integration_requests_info(
-					integration_request.reference_doctype, integration_request.reference_docname, checkout_id
+				total_paid, mpesa_receipts = update_payment_totals(
+					integration_request, amount, mpesa_receipt
 				)
 
-				total_paid = amount + sum(completed_payments)
-				mpesa_receipts = ", ".join(mpesa_receipts + [mpesa_receipt])
-
 				if total_paid >= pr.grand_total:
 					pr.run_method("on_payment_authorized", "Completed")
 					success = True
@@ -206,6 +461,8 @@ def verify_transaction(**kwargs):
 				frappe.db.set_value("POS Invoice", pr.reference_name, "mpesa_receipt_number", mpesa_receipts)
 				integration_request.handle_success(transaction_response)
 			except Exception:
+				# undo the running totals, this callback is not counted as paid
+				frappe.db.rollback(save_point="mpesa_verify_transaction")
 				integration_request.handle_failure(transaction_response)
 				frappe.log_error("Mpesa: Failed to verify transaction")
 
@@ -227,6 +484,56 @@ def verify_transaction(**kwargs):
 	)
 
 
+def update_payment_totals(integration_request, amount, mpesa_receipt):
+	"""
+	Add a successful callback to the running totals kept on the reference document
+	and return the new `(total_paid, mpesa_receipts)`.
+
+	The reference row is locked first, so concurrent callbacks for the same POS Invoice
+	are applied one at a time, and a callback that was already counted is skipped.
+	"""
+	reference_doctype = integration_request.reference_doctype
+	reference_docname = integration_request.reference_docname
+
+	if not frappe.get_meta(reference_doctype).has_field("mpesa_amount_paid"):
+		mpesa_receipts, completed_payments = get_completed_integration_requests_info(
+			reference_doctype, reference_docname, integration_request.name
+		)
+		return amount + sum(completed_payments), ", ".join(mpesa_receipts + [mpesa_receipt])
+
+	totals = frappe.db.get_value(
+		reference_doctype,
+		reference_docname,
+		["mpesa_amount_paid", "mpesa_request_count", "mpesa_receipts"],
+		as_dict=True,
+		for_update=True,
+	)
+
+	if not totals.mpesa_request_count:
+		# first callback, or requests completed before the totals were tracked
+		mpesa_receipts, completed_payments = get_completed_integration_requests_info(
+			reference_doctype, reference_docname, integration_request.name
+		)
+		totals.update(
+			mpesa_amount_paid=sum(completed_payments),
+			mpesa_request_count=len(completed_payments),
+			mpesa_receipts=", ".join(mpesa_receipts),
+		)
+
+	# locking read, so a retried callback sees the status committed by the first one
+	status = frappe.db.get_value(
+		"Integration Request", integration_request.name, "status", for_update=True
+	)
+	if status != "Completed":
+		totals.mpesa_amount_paid = flt(totals.mpesa_amount_paid) + flt(amount)
+		totals.mpesa_request_count += 1
+		totals.mpesa_receipts = ", ".join(filter(None, [totals.mpesa_receipts, mpesa_receipt]))
+
+		frappe.db.set_value(reference_doctype, reference_docname, totals, update_modified=False)
+
+	return totals.mpesa_amount_paid, totals.mpesa_receipts
+
+
 def get_completed_integration_requests_info(reference_doctype, reference_docname, checkout_id):
 	output_of_other_completed_requests = frappe.get_all(
 		"Integration Request",
@@ -242,7 +549,7 @@ def get_completed_integration_requests_info(reference_doctype, reference_docname
 	mpesa_receipts, completed_payments = [], []
 
 	for out in output_of_other_completed_requests:
-		out = frappe._dict(loads(out))
+		out = decode_payload(out)
 		item_response = out["CallbackMetadata"]["Item"]
 		completed_amount = fetch_param_value(item_response, "Amount", "Name")
 		completed_mpesa_receipt = fetch_param_value(item_response, "MpesaReceiptNumber", "Name")
@@ -256,26 +563,23 @@ def get_account_balance(request_payload):
 	"""Call account balance API to send the request to the Mpesa Servers."""
 	try:
 		mpesa_settings = frappe.get_doc("Mpesa Settings", request_payload.get("reference_docname"))
-		env = "production" if not mpesa_settings.sandbox else "sandbox"
-		connector = MpesaConnector(
-			env=env,
-			app_key=mpesa_settings.consumer_key,
-			app_secret=mpesa_settings.get_password("consumer_secret"),
-		)
+		connector = get_mpesa_connector(mpesa_settings)
 
 		callback_url = (
 			get_request_site_address(True)
 			+ "/api/method/payments.payment_gateways.doctype.mpesa_settings.mpesa_settings.process_balance_info"
 		)
 
-		response = connector.get_balance(
-			mpesa_settings.initiator_name,
-			mpesa_settings.security_credential,
-			mpesa_settings.till_number,
-			4,
-			mpesa_settings.name,
-			callback_url,
-			callback_url,
+		response = call_with_access_token(
+			mpesa_settings,
+			connector.get_balance,
+			initiator=mpesa_settings.initiator_name,
+			security_credential=mpesa_settings.security_credential,
+			party_a=mpesa_settings.till_number,
+			identifier_type=4,
+			remarks=mpesa_settings.name,
+			queue_timeout_url=callback_url,
+			result_url=callback_url,
 		)
 		return response
 	except Exception:
@@ -297,7 +601,7 @@ def process_balance_info(**kwargs):
 	if request.status == "Completed":
 		return
 
-	transaction_data = frappe._dict(loads(request.data))
+	transaction_data = decode_payload(request.data)
 
 	if account_balance_response["ResultCode"] == 0:
 		try:
@@ -292,6 +292,93 @@ class TestMpesaSettings(unittest.TestCase):
 		pr.delete()
 		pos_invoice.delete()
 
+	def test_processing_of_duplicate_and_out_of_order_callbacks(self):
+		mpesa_account = frappe.db.get_value(
+			"Payment Gateway Account", {"payment_gateway": "Mpesa-Payment"}, "payment_account"
+		)
+		frappe.db.set_value("Account", mpesa_account, "account_currency", "KES")
+		frappe.db.set_value("Mpesa Settings", "Payment", "transaction_limit", "500")
+		frappe.db.set_value("Customer", "_Test Customer", "default_currency", "KES")
+
+		pos_invoice = create_pos_invoice(
+			item=self.item,
+			customer=self.customer,
+			debit_to="Debtors - WP",
+			warehouse="Stores - WP",
+			cost_center="Main - WP",
+			company="Wind Power LLC",
+			income_account="Sales - WP",
+			pos_profile=self.pos_profile,
+			account_for_change_amount="Cash - WP",
+			expense_account="Cost of Goods Sold - WP",
+			do_not_submit=1,
+		)
+		pos_invoice.append(
+			"payments", {"mode_of_payment": "Mpesa-Payment", "account": mpesa_account, "amount": 1500}
+		)
+		pos_invoice.contact_mobile = "093456543894"
+		pos_invoice.currency = "KES"
+		pos_invoice.save()
+
+		pr = pos_invoice.create_payment_request()
+		integration_req_ids = frappe.get_all(
+			"Integration Request",
+			filters={
+				"reference_doctype": pr.doctype,
+				"reference_docname": pr.name,
+			},
+			pluck="name",
+			order_by="creation",
+		)
+		# 1500 split in requests of the 500 transaction limit
+		self.assertEqual(len(integration_req_ids), 3)
+
+		mpesa_receipt_numbers = [frappe.utils.random_string(5) for d in integration_req_ids]
+
+		def send_callback(index):
+			verify_transaction(
+				**get_payment_callback_payload(
+					Amount=500,
+					CheckoutRequestID=integration_req_ids[index],
+					MpesaReceiptNumber=mpesa_receipt_numbers[index],
+				)
+			)
+			return frappe.db.get_value(
+				"Payment Request",
+				pr.name,
+				["mpesa_amount_paid", "mpesa_request_count", "mpesa_receipts", "status"],
+				as_dict=True,
+			)
+
+		# the last request is answered first, then M-Pesa retries its callback
+		send_callback(2)
+		send_callback(0)
+		totals = send_callback(2)
+		self.assertEqual(totals.mpesa_amount_paid, 1000)
+		self.assertEqual(totals.mpesa_request_count, 2)
+		self.assertEqual(
+			totals.mpesa_receipts, ", ".join(mpesa_receipt_numbers[i] for i in (2, 0))
+		)
+		self.assertNotEqual(totals.status, "Paid")
+
+		totals = send_callback(1)
+		self.assertEqual(totals.mpesa_amount_paid, 1500)
+		self.assertEqual(totals.mpesa_request_count, 3)
+		self.assertEqual(
+			totals.mpesa_receipts, ", ".join(mpesa_receipt_numbers[i] for i in (2, 0, 1))
+		)
+		self.assertEqual(totals.status, "Paid")
+
+		pos_invoice.reload()
+		self.assertEqual(pos_invoice.mpesa_receipt_number, totals.mpesa_receipts)
+
+		frappe.db.set_value("Customer", "_Test Customer", "default_currency", "")
+		frappe.db.sql("delete from `tabIntegration Request` where integration_request_service = 'Mpesa'")
+		pr.reload()
+		pr.cancel()
+		pr.delete()
+		pos_invoice.delete()
+
 
 def create_mpesa_settings(payment_gateway_name="Express"):
 	if frappe.db.exists("Mpesa Settings", payment_gateway_name):
@@ -68,15 +68,29 @@ from urllib.parse import urlencode
 import frappe
 import pytz
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_post_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, get_datetime, get_url
 from frappe.utils.data import get_system_timezone
 
-from payments.utils import create_payment_gateway
+from payments.payment_gateways.subscription_notifications import (
+	enqueue_notification_processing,
+)
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_settings_snapshot,
+)
+from payments.utils.circuit_breaker import circuit_breaker
+from payments.utils.codec import decode_payload
+from payments.utils.secret_cache import get_doc_password
+from payments.utils.transport import make_post_request
 
 api_path = "/api/method/payments.payment_gateways.doctype.paypal_settings.paypal_settings"
 
+# verified recurring profiles are remembered for a day, see `validate_ipn_request`
+PROFILE_CACHE_TTL = 86400
+
 
 class PayPalSettings(Document):
 	supported_currencies = [
@@ -111,7 +125,7 @@ class PayPalSettings(Document):
 		setattr(self, "use_sandbox", 0)
 
 	def setup_sandbox_env(self, token):
-		data = json.loads(frappe.db.get_value("Integration Request", token, "data"))
+		data = decode_payload(frappe.db.get_value("Integration Request", token, "data"))
 		setattr(self, "use_sandbox", cint(frappe._dict(data).use_sandbox) or 0)
 
 	def validate(self):
@@ -121,7 +135,10 @@ class PayPalSettings(Document):
 			self.validate_paypal_credentails()
 
 	def on_update(self):
-		pass
+		clear_payment_gateway_cache(self)
+
+	def on_trash(self):
+		clear_payment_gateway_cache(self)
 
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
@@ -134,7 +151,7 @@ class PayPalSettings(Document):
 	def get_paypal_params_and_url(self):
 		params = {
 			"USER": self.api_username,
-			"PWD": self.get_password(fieldname="api_password", raise_exception=False),
+			"PWD": get_doc_password(self, "api_password"),
 			"SIGNATURE": self.signature,
 			"VERSION": "98",
 			"METHOD": "GetPalDetails",
@@ -162,7 +179,7 @@ class PayPalSettings(Document):
 		params = urlencode(params)
 
 		try:
-			res = make_post_request(url=url, data=params.encode("utf-8"))
+			res = make_post_request(url=url, data=params.encode("utf-8"), gateway="PayPal")
 
 			if res["ACK"][0] == "Failure":
 				raise Exception
@@ -209,7 +226,8 @@ class PayPalSettings(Document):
 			self.configure_recurring_payments(params, kwargs)
 
 		params = urlencode(params)
-		response = make_post_request(url, data=params.encode("utf-8"))
+		with circuit_breaker("PayPal", self.name):
+			response = make_post_request(url, data=params.encode("utf-8"), gateway="PayPal")
 
 		if response.get("ACK")[0] != "Success":
 			frappe.throw(_("Looks like something is wrong with this site's Paypal configuration."))
@@ -234,12 +252,12 @@ class PayPalSettings(Document):
 
 
 def get_paypal_and_transaction_details(token):
-	doc = frappe.get_doc("PayPal Settings")
+	doc = get_settings_snapshot("PayPal Settings")
 	doc.setup_sandbox_env(token)
 	params, url = doc.get_paypal_params_and_url()
 
 	integration_request = frappe.get_doc("Integration Request", token)
-	data = json.loads(integration_request.data)
+	data = decode_payload(integration_request.data)
 
 	return data, params, url
 
@@ -265,13 +283,13 @@ def setup_redirect(data, redirect_url, custom_redirect_to=None, redirect=True):
 @frappe.whitelist(allow_guest=True, xss_safe=True)
 def get_express_checkout_details(token):
 	try:
-		doc = frappe.get_doc("PayPal Settings")
+		doc = get_settings_snapshot("PayPal Settings")
 		doc.setup_sandbox_env(token)
 
 		params, url = doc.get_paypal_params_and_url()
 		params.update({"METHOD": "GetExpressCheckoutDetails", "TOKEN": token})
 
-		response = make_post_request(url, data=params)
+		response = make_post_request(url, data=params, gateway="PayPal")
 
 		if response.get("ACK")[0] != "Success":
 			frappe.respond_as_web_page(
@@ -317,7 +335,7 @@ def confirm_payment(token):
 			}
 		)
 
-		response = make_post_request(url, data=params)
+		response = make_post_request(url, data=params, gateway="PayPal")
 
 		if response.get("ACK")[0] == "Success":
 			update_integration_request_status(
@@ -384,7 +402,7 @@ def create_recurring_profile(token, payerid):
 		# "PROFILESTARTDATE": datetime.utcfromtimestamp(get_timestamp(starts_at)).isoformat()
 		params.update({"PROFILESTARTDATE": starts_at.isoformat()})
 
-		response = make_post_request(url, data=params)
+		response = make_post_request(url, data=params, gateway="PayPal")
 
 		if response.get("ACK")[0] == "Success":
 			update_integration_request_status(
@@ -424,7 +442,7 @@ def update_integration_request_status(token, data, status, error=False, doc=None
 
 
 def get_redirect_uri(doc, token, payerid):
-	data = json.loads(doc.data)
+	data = decode_payload(doc.data)
 
 	if data.get("subscription_details"):
 		return get_url(f"{api_path}.create_recurring_profile?token={token}&payerid={payerid}")
@@ -441,7 +459,7 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 		}
 	)
 
-	response = make_post_request(url, data=args)
+	response = make_post_request(url, data=args, gateway="PayPal")
 
 	# error code 11556 indicates profile is not in active state(or already cancelled)
 	# thus could not cancel the subscription.
@@ -453,46 +471,59 @@ def manage_recurring_payment_profile_status(profile_id, action, args, url):
 
 @frappe.whitelist(allow_guest=True)
 def ipn_handler():
+	"""Store the IPN and acknowledge it, the recurring profile is verified when the
+	notification is processed (see `payments.payment_gateways.subscription_notifications`).
+
+	IPNs are named after their `ipn_track_id`, so messages PayPal sends again are only
+	stored and processed once.
+	"""
 	try:
 		data = frappe.local.form_dict
 
-		validate_ipn_request(data)
+		if not data.get("recurring_payment_id"):
+			return
 
 		data.update({"payment_gateway": "PayPal"})
 
-		doc = frappe.get_doc(
+		frappe.get_doc(
 			{
 				"data": json.dumps(frappe.local.form_dict),
 				"doctype": "Integration Request",
+				"integration_request_service": "PayPal",
 				"request_description": "Subscription Notification",
 				"is_remote_request": 1,
 				"status": "Queued",
 			}
-		).insert(ignore_permissions=True)
-		frappe.db.commit()
-
-		frappe.enqueue(
-			method="payments.payment_gateways.doctype.paypal_settings.paypal_settings.handle_subscription_notification",
-			queue="long",
-			timeout=600,
-			is_async=True,
-			**{"doctype": "Integration Request", "docname": doc.name},
-		)
+		).insert(ignore_permissions=True, set_name=get_ipn_log_name(data))
 
-	except frappe.InvalidStatusError:
+		enqueue_notification_processing()
+
+	except frappe.DuplicateEntryError:
+		# already received
 		pass
 	except Exception as e:
 		frappe.log(frappe.log_error(title=e))
 
 
+def get_ipn_log_name(data):
+	if data.get("ipn_track_id"):
+		return "PayPal IPN {}".format(data.get("ipn_track_id"))
+
+
 def validate_ipn_request(data):
 	def _throw():
 		frappe.throw(_("In Valid Request"), exc=frappe.InvalidStatusError)
 
-	if not data.get("recurring_payment_id"):
+	profile_id = data.get("recurring_payment_id")
+	if not profile_id:
 		_throw()
 
-	doc = frappe.get_doc("PayPal Settings")
+	# profiles only need to be looked up once
+	cache_key = f"paypal_verified_profile|{profile_id}"
+	if frappe.cache().get_value(cache_key):
+		return
+
+	doc = get_settings_snapshot("PayPal Settings")
 	params, url = doc.get_paypal_params_and_url()
 
 	params.update(
@@ -503,11 +534,18 @@ def validate_ipn_request(data):
 	)
 
 	params = urlencode(params)
-	res = make_post_request(url=url, data=params.encode("utf-8"))
+	res = make_post_request(url=url, data=params.encode("utf-8"), gateway="PayPal")
 
 	if res["ACK"][0] != "Success":
 		_throw()
 
+	frappe.cache().set_value(
+		cache_key,
+		1,
+		expires_in_sec=cint(frappe.conf.paypal_profile_cache_ttl) or PROFILE_CACHE_TTL,
+	)
+
 
 def handle_subscription_notification(doctype, docname):
+	# notifications are processed in batches now, this runs jobs enqueued before that
 	call_hook_method("handle_subscription_notification", doctype=doctype, docname=docname)
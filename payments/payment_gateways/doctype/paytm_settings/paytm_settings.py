@@ -5,7 +5,6 @@ import json
 from urllib.parse import urlencode
 
 import frappe
-import requests
 from frappe import _
 from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
@@ -17,10 +16,17 @@ from frappe.utils import (
 	get_request_site_address,
 	get_url,
 )
-from frappe.utils.password import get_decrypted_password
 from paytmchecksum import generateSignature, verifySignature
 
-from payments.utils import create_payment_gateway
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_reference_gateway_controller,
+	get_settings_snapshot,
+)
+from payments.utils.codec import decode_payload
+from payments.utils.secret_cache import get_cached_password
+from payments.utils.transport import send_request
 
 
 class PaytmSettings(Document):
@@ -30,6 +36,12 @@ class PaytmSettings(Document):
 		create_payment_gateway("Paytm")
 		call_hook_method("payment_gateway_enabled", gateway="Paytm")
 
+	def on_update(self):
+		clear_payment_gateway_cache(self)
+
+	def on_trash(self):
+		clear_payment_gateway_cache(self)
+
 	def validate_transaction_currency(self, currency):
 		if currency not in self.supported_currencies:
 			frappe.throw(
@@ -50,9 +62,9 @@ class PaytmSettings(Document):
 def get_paytm_config():
 	"""Returns paytm config"""
 
-	paytm_config = frappe.db.get_singles_dict("Paytm Settings")
+	paytm_config = frappe._dict(get_settings_snapshot("Paytm Settings").as_dict())
 	paytm_config.update(
-		dict(merchant_key=get_decrypted_password("Paytm Settings", "Paytm Settings", "merchant_key"))
+		dict(merchant_key=get_cached_password("Paytm Settings", "Paytm Settings", "merchant_key"))
 	)
 
 	if cint(paytm_config.staging):
@@ -142,13 +154,15 @@ def verify_transaction_status(paytm_config, order_id):
 	post_data = json.dumps(paytm_params)
 	url = paytm_config.transaction_status_url
 
-	response = requests.post(url, data=post_data, headers={"Content-type": "application/json"}).json()
+	response = send_request(
+		"Paytm", "POST", url, data=post_data, headers={"Content-type": "application/json"}
+	).json()
 	finalize_request(order_id, response)
 
 
 def finalize_request(order_id, transaction_response):
 	request = frappe.get_doc("Integration Request", order_id)
-	transaction_data = frappe._dict(json.loads(request.data))
+	transaction_data = decode_payload(request.data)
 	redirect_to = transaction_data.get("redirect_to") or None
 	redirect_message = transaction_data.get("redirect_message") or None
 
@@ -182,8 +196,4 @@ def finalize_request(order_id, transaction_response):
 
 
 def get_gateway_controller(doctype, docname):
-	reference_doc = frappe.get_doc(doctype, docname)
-	gateway_controller = frappe.db.get_value(
-		"Payment Gateway", reference_doc.payment_gateway, "gateway_controller"
-	)
-	return gateway_controller
+	return get_reference_gateway_controller(doctype, docname)
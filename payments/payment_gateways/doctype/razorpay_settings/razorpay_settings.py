@@ -62,20 +62,40 @@ For razorpay payment status is Authorized
 import hashlib
 import hmac
 import json
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlencode
 
 import frappe
 import razorpay
 from frappe import _
-from frappe.integrations.utils import (
-	create_request_log,
-	make_get_request,
-	make_post_request,
-)
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
-from frappe.utils import call_hook_method, cint, get_timestamp, get_url
+from frappe.utils import call_hook_method, cint, get_timestamp, get_url, now
+from redis.exceptions import LockError
+
+from payments.payment_gateways.subscription_notifications import (
+	enqueue_notification_processing,
+)
+from payments.utils import (
+	clear_payment_gateway_cache,
+	create_payment_gateway,
+	get_settings_snapshot,
+)
+from payments.utils.codec import decode_payload
+from payments.utils.logger import get_logger
+from payments.utils.secret_cache import get_cached_password, get_doc_password
+from payments.utils.transport import get_session, get_timeout, make_get_request, make_post_request
 
-from payments.utils import create_payment_gateway
+logger = get_logger("Razorpay")
+
+RAZORPAY_API_URL = "https://api.razorpay.com/v1"
+
+# capture_payment runs on every scheduler tick
+CAPTURE_PAGE_SIZE = 100
+CAPTURE_WORKERS = 4
+CAPTURE_LOCK_TIMEOUT = 300
 
 
 class RazorpaySettings(Document):
@@ -83,7 +103,7 @@ class RazorpaySettings(Document):
 
 	def init_client(self):
 		if self.api_key:
-			secret = self.get_password(fieldname="api_secret", raise_exception=False)
+			secret = get_doc_password(self, "api_secret")
 			self.client = razorpay.Client(auth=(self.api_key, secret))
 
 	def validate(self):
@@ -92,6 +112,12 @@ class RazorpaySettings(Document):
 		if not self.flags.ignore_mandatory:
 			self.validate_razorpay_credentails()
 
+	def on_update(self):
+		clear_payment_gateway_cache(self)
+
+	def on_trash(self):
+		clear_payment_gateway_cache(self)
+
 	def validate_razorpay_credentails(self):
 		if self.api_key and self.api_secret:
 			try:
@@ -101,6 +127,7 @@ class RazorpaySettings(Document):
 						self.api_key,
 						self.get_password(fieldname="api_secret", raise_exception=False),
 					),
+					gateway="Razorpay",
 				)
 			except Exception:
 				frappe.throw(_("Seems API Key or API Secret is wrong !!!"))
@@ -138,6 +165,7 @@ class RazorpaySettings(Document):
 					auth=(settings.api_key, settings.api_secret),
 					data=json.dumps(addon),
 					headers={"content-type": "application/json"},
+					gateway="Razorpay",
 				)
 				if not resp.get("id"):
 					frappe.log_error(message=str(resp), title="Razorpay Failed while creating subscription")
@@ -172,6 +200,7 @@ class RazorpaySettings(Document):
 				auth=(settings.api_key, settings.api_secret),
 				data=json.dumps(subscription_details),
 				headers={"content-type": "application/json"},
+				gateway="Razorpay",
 			)
 
 			if resp.get("status") == "created":
@@ -219,9 +248,10 @@ class RazorpaySettings(Document):
 					"https://api.razorpay.com/v1/orders",
 					auth=(
 						self.api_key,
-						self.get_password(fieldname="api_secret", raise_exception=False),
+						get_doc_password(self, "api_secret"),
 					),
 					data=payment_options,
+					gateway="Razorpay",
 				)
 				order["integration_request"] = integration_request.name
 				return order  # Order returned to be consumed by razorpay.js
@@ -255,13 +285,14 @@ class RazorpaySettings(Document):
 		The money is deducted from the customer’s account, but will not be transferred to the merchant’s account
 		until it is explicitly captured by merchant.
 		"""
-		data = json.loads(self.integration_request.data)
+		data = decode_payload(self.integration_request.data)
 		settings = self.get_settings(data)
 
 		try:
 			resp = make_get_request(
 				f"https://api.razorpay.com/v1/payments/{self.data.razorpay_payment_id}",
 				auth=(settings.api_key, settings.api_secret),
+				gateway="Razorpay",
 			)
 
 			if resp.get("status") == "authorized":
@@ -323,11 +354,11 @@ class RazorpaySettings(Document):
 		settings = frappe._dict(
 			{
 				"api_key": self.api_key,
-				"api_secret": self.get_password(fieldname="api_secret", raise_exception=False),
+				"api_secret": get_doc_password(self, "api_secret"),
 			}
 		)
 
-		if cint(data.get("notes", {}).get("use_sandbox")) or data.get("use_sandbox"):
+		if is_sandbox_request(data):
 			settings.update(
 				{
 					"api_key": frappe.conf.sandbox_api_key,
@@ -344,6 +375,7 @@ class RazorpaySettings(Document):
 			resp = make_post_request(
 				f"https://api.razorpay.com/v1/subscriptions/{subscription_id}/cancel",
 				auth=(settings.api_key, settings.api_secret),
+				gateway="Razorpay",
 			)
 		except Exception:
 			frappe.log_error(frappe.get_traceback())
@@ -370,48 +402,141 @@ def capture_payment(is_sandbox=False, sanbox_response=None):
 	where T is the day on which payment is captured.
 
 	Note: Attempting to capture a payment whose status is not authorized will produce an error.
+
+	Authorized requests are streamed in pages and captured by a bounded thread pool,
+	throttled by the Razorpay rate limiter of the API key. A Redis lock keeps
+	overlapping scheduler ticks from capturing the same payments twice.
 	"""
-	controller = frappe.get_doc("Razorpay Settings")
+	lock = frappe.cache().lock(
+		frappe.cache().make_key("razorpay_capture_payment"), timeout=CAPTURE_LOCK_TIMEOUT
+	)
+	if not lock.acquire(blocking=False):
+		# previous run is still working through the backlog
+		return
 
-	for doc in frappe.get_all(
-		"Integration Request",
-		filters={"status": "Authorized", "integration_request_service": "Razorpay"},
-		fields=["name", "data"],
-	):
+	try:
+		return capture_authorized_payments(lock, is_sandbox, sanbox_response)
+	finally:
 		try:
-			if is_sandbox:
-				resp = sanbox_response
-			else:
-				data = json.loads(doc.data)
-				settings = controller.get_settings(data)
+			lock.release()
+		except LockError:
+			pass
 
-				resp = make_get_request(
-					"https://api.razorpay.com/v1/payments/{}".format(data.get("razorpay_payment_id")),
-					auth=(settings.api_key, settings.api_secret),
-					data={"amount": data.get("amount")},
+
+def capture_authorized_payments(lock, is_sandbox=False, sanbox_response=None):
+	filters = {"status": "Authorized", "integration_request_service": "Razorpay"}
+	stats = frappe._dict(
+		backlog=frappe.db.count("Integration Request", filters), captured=0, failed=0
+	)
+	started = time.monotonic()
+
+	controller = get_settings_snapshot("Razorpay Settings")
+	settings = {}
+	session = get_session("Razorpay", RAZORPAY_API_URL)
+	timeout = get_timeout("Razorpay")
+	workers = cint(frappe.conf.razorpay_capture_workers) or CAPTURE_WORKERS
+
+	last_name = ""
+	with ThreadPoolExecutor(max_workers=workers) as executor:
+		while True:
+			page = frappe.get_all(
+				"Integration Request",
+				filters={**filters, "name": [">", last_name]},
+				fields=["name", "data"],
+				order_by="name asc",
+				limit=CAPTURE_PAGE_SIZE,
+			)
+			if not page:
+				break
+
+			last_name = page[-1].name
+			jobs, captured, failed = {}, [], {}
+			for doc in page:
+				try:
+					data = decode_payload(doc.data)
+					use_sandbox = is_sandbox_request(data)
+					if use_sandbox not in settings:
+						# decrypt the API secret once per run instead of once per row
+						settings[use_sandbox] = controller.get_settings(data)
+				except Exception:
+					failed[doc.name] = frappe.get_traceback()
+					continue
+
+				jobs[doc.name] = executor.submit(
+					capture_razorpay_payment,
+					data,
+					settings[use_sandbox],
+					session,
+					timeout,
+					sanbox_response if is_sandbox else None,
 				)
 
-				if resp.get("status") == "authorized":
-					resp = make_post_request(
-						"https://api.razorpay.com/v1/payments/{}/capture".format(data.get("razorpay_payment_id")),
-						auth=(settings.api_key, settings.api_secret),
-						data={"amount": data.get("amount")},
-					)
+			for name, job in jobs.items():
+				resp, error = job.result()
+				if error:
+					failed[name] = error
+				elif resp.get("status") == "captured":
+					captured.append(name)
 
-			if resp.get("status") == "captured":
-				frappe.db.set_value("Integration Request", doc.name, "status", "Completed")
+			update_capture_status(captured, failed)
+			frappe.db.commit()
+
+			stats.captured += len(captured)
+			stats.failed += len(failed)
+			lock.reacquire()
+
+	stats.elapsed = round(time.monotonic() - started, 3)
+	stats.per_second = (
+		round((stats.captured + stats.failed) / stats.elapsed, 2) if stats.elapsed else 0
+	)
+	logger.info("capture_run_completed", **stats)
+
+	return stats
 
-		except Exception:
-			doc = frappe.get_doc("Integration Request", doc.name)
-			doc.status = "Failed"
-			doc.error = frappe.get_traceback()
-			doc.save()
-			frappe.log_error(doc.error, f"{doc.name} Failed")
+
+def capture_razorpay_payment(data, settings, session, timeout, sandbox_response=None):
+	"""Capture one payment. Runs in a worker thread, so it must not use `frappe.local`."""
+	if sandbox_response:
+		return sandbox_response, None
+
+	try:
+		url = "{}/payments/{}".format(RAZORPAY_API_URL, data.get("razorpay_payment_id"))
+		auth = (settings.api_key, settings.api_secret)
+		params = {"amount": data.get("amount")}
+
+		resp = session.get(url, auth=auth, data=params, timeout=timeout)
+		resp.raise_for_status()
+		resp = resp.json()
+
+		if resp.get("status") == "authorized":
+			resp = session.post(f"{url}/capture", auth=auth, data=params, timeout=timeout)
+			resp.raise_for_status()
+			resp = resp.json()
+
+		return resp, None
+
+	except Exception:
+		return None, traceback.format_exc()
+
+
+def update_capture_status(captured, failed):
+	if captured:
+		integration_request = frappe.qb.DocType("Integration Request")
+		(
+			frappe.qb.update(integration_request)
+			.set(integration_request.status, "Completed")
+			.set(integration_request.modified, now())
+			.where(integration_request.name.isin(captured))
+		).run()
+
+	for name, error in failed.items():
+		frappe.db.set_value("Integration Request", name, {"status": "Failed", "error": error})
+		frappe.log_error(error, f"{name} Failed")
 
 
 @frappe.whitelist(allow_guest=True)
 def get_api_key():
-	controller = frappe.get_doc("Razorpay Settings")
+	controller = get_settings_snapshot("Razorpay Settings")
 	return controller.api_key
 
 
@@ -444,8 +569,8 @@ def order_payment_success(integration_request, params):
 	integration.update_status(params, integration.status)
 	integration.reload()
 
-	data = json.loads(integration.data)
-	controller = frappe.get_doc("Razorpay Settings")
+	data = decode_payload(integration.data)
+	controller = get_settings_snapshot("Razorpay Settings")
 
 	# Update payment and integration data for payment controller object
 	controller.integration_request = integration
@@ -469,6 +594,10 @@ def order_payment_failure(integration_request, params):
 	integration.update_status(params, integration.status)
 
 
+def is_sandbox_request(data):
+	return bool(cint(data.get("notes", {}).get("use_sandbox")) or data.get("use_sandbox"))
+
+
 def convert_rupee_to_paisa(**kwargs):
 	for addon in kwargs.get("addons"):
 		addon["item"]["amount"] *= 100
@@ -478,38 +607,56 @@ def convert_rupee_to_paisa(**kwargs):
 
 @frappe.whitelist(allow_guest=True)
 def razorpay_subscription_callback():
+	"""Webhook for subscription events.
+
+	The `X-Razorpay-Signature` of the webhook is verified against the webhook secret, if
+	one is set, and the event acknowledged right away; the subscription is cross-checked
+	with Razorpay once, when the notification is processed (see
+	`payments.payment_gateways.subscription_notifications`).
+	"""
 	try:
 		data = frappe.local.form_dict
 
-		validate_payment_callback(data)
+		webhook_secret = get_cached_password(
+			"Razorpay Settings", "Razorpay Settings", "webhook_secret"
+		)
+		if webhook_secret:
+			verify_webhook_signature(webhook_secret)
 
 		data.update({"payment_gateway": "Razorpay"})
 
-		doc = frappe.get_doc(
+		frappe.get_doc(
 			{
 				"data": json.dumps(frappe.local.form_dict),
 				"doctype": "Integration Request",
+				"integration_request_service": "Razorpay",
 				"request_description": "Subscription Notification",
 				"is_remote_request": 1,
 				"status": "Queued",
 			}
 		).insert(ignore_permissions=True)
-		frappe.db.commit()
-
-		frappe.enqueue(
-			method="payments.payment_gateways.doctype.razorpay_settings.razorpay_settings.handle_subscription_notification",
-			queue="long",
-			timeout=600,
-			is_async=True,
-			**{"doctype": "Integration Request", "docname": doc.name},
-		)
+
+		enqueue_notification_processing()
 
 	except frappe.InvalidStatusError:
 		pass
+	except frappe.PermissionError:
+		raise
 	except Exception as e:
 		frappe.log(frappe.log_error(title=e))
 
 
+def verify_webhook_signature(webhook_secret):
+	"""Throw `frappe.PermissionError` unless the request body is signed with the secret"""
+	signature = frappe.get_request_header("X-Razorpay-Signature")
+	if not signature:
+		frappe.throw(_("Razorpay Signature Verification Failed"), exc=frappe.PermissionError)
+
+	get_settings_snapshot("Razorpay Settings").verify_signature(
+		frappe.request.get_data(as_text=True), signature, webhook_secret
+	)
+
+
 def validate_payment_callback(data):
 	def _throw():
 		frappe.throw(_("Invalid Subscription"), exc=frappe.InvalidStatusError)
@@ -519,13 +666,14 @@ def validate_payment_callback(data):
 	if not (subscription_id):
 		_throw()
 
-	controller = frappe.get_doc("Razorpay Settings")
+	controller = get_settings_snapshot("Razorpay Settings")
 
 	settings = controller.get_settings(data)
 
 	resp = make_get_request(
 		f"https://api.razorpay.com/v1/subscriptions/{subscription_id}",
 		auth=(settings.api_key, settings.api_secret),
+		gateway="Razorpay",
 	)
 
 	if resp.get("status") != "active":
@@ -533,4 +681,13 @@ def validate_payment_callback(data):
 
 
 def handle_subscription_notification(doctype, docname):
+	# notifications are processed in batches now, this runs jobs enqueued before that
+	integration_request = frappe.get_doc(doctype, docname)
+
+	try:
+		validate_payment_callback(decode_payload(integration_request.data))
+	except frappe.InvalidStatusError:
+		integration_request.handle_failure({"error": "Invalid Subscription"})
+		return
+
 	call_hook_method("handle_subscription_notification", doctype=doctype, docname=docname)
@@ -2,17 +2,36 @@
 # License: MIT. See LICENSE
 
 import json
+import threading
+import urllib.parse
 from typing import Any
 from urllib.parse import urlencode
 
 import frappe
 import stripe
 from frappe import _
-from frappe.integrations.utils import create_request_log, make_get_request
+from frappe.integrations.utils import create_request_log
 from frappe.model.document import Document
 from frappe.utils import call_hook_method, cint, flt, get_url
+from frappe.utils.password import get_decrypted_password
 
-from payments.utils import create_payment_gateway
+from payments.utils import (
+    clear_payment_gateway_cache,
+    create_payment_gateway,
+    get_reference_gateway_controller,
+    get_settings_cache,
+)
+from payments.utils.codec import encode_payload
+from payments.utils.logger import get_logger
+from payments.utils.transport import get_session, get_timeout, make_get_request
+
+logger = get_logger("Stripe")
+
+# pooled HTTP client of each site, see `set_default_http_client`
+_http_clients = {}
+_http_client_lock = threading.Lock()
+# client of the `StripeClient` call running in the current thread
+_active_http_client = threading.local()
 
 
 class StripeSettings(Document):
@@ -160,9 +179,13 @@ class StripeSettings(Document):
         call_hook_method(
             "payment_gateway_enabled", gateway="Stripe-" + self.gateway_name
         )
+        clear_payment_gateway_cache(self)
         if not self.flags.ignore_mandatory:
             self.validate_stripe_credentails()
 
+    def on_trash(self):
+        clear_payment_gateway_cache(self)
+
     def validate_stripe_credentails(self):
         if self.publishable_key and self.secret_key:
             header = {
@@ -172,7 +195,9 @@ class StripeSettings(Document):
             }
             try:
                 make_get_request(
-                    url="https://api.stripe.com/v1/charges", headers=header
+                    url="https://api.stripe.com/v1/charges",
+                    headers=header,
+                    gateway="Stripe",
                 )
             except Exception:
                 frappe.throw(_("Seems Publishable Key or Secret Key is wrong !!!"))
@@ -202,15 +227,12 @@ class StripeSettings(Document):
     def get_payment_url(self, **kwargs):
         return get_url(f"./stripe_checkout?{urlencode(kwargs)}")
 
-    def create_request(self, data, save_payment_method="", result_stripe={}) -> dict:
-        import stripe
+    def get_client(self) -> "StripeClient":
+        return get_stripe_client(self.name)
 
+    def create_request(self, data, save_payment_method="", result_stripe={}) -> dict:
         self.data = frappe._dict(data)
-        stripe.api_key = self.get_password(
-            fieldname="secret_key", raise_exception=False
-        )
-
-        stripe.default_http_client = stripe.http_client.RequestsClient()
+        self.client = self.get_client()
 
         try:
             self.integration_request = create_request_log(
@@ -234,6 +256,86 @@ class StripeSettings(Document):
                 "status": 401,
             }
 
+    def create_request_with_saved_card(self, data, card) -> dict:
+        """
+        Cobra con una tarjeta guardada (PayGate Card) sin pasar por Stripe.js: el
+        PaymentIntent se confirma fuera de sesion con el cliente y la forma de pago
+        registrados en la tarjeta.
+        """
+        self.data = frappe._dict(data)
+        self.client = self.get_client()
+
+        try:
+            self.integration_request = create_request_log(
+                self.data, service_name="Stripe"
+            )
+            return self.charge_saved_card(card)
+
+        except Exception:
+            frappe.log_error(
+                title="Error create request stripe", message=frappe.get_traceback()
+            )
+            return {
+                "redirect_to": frappe.redirect_to_message(
+                    _("Server Error"),
+                    _(
+                        "It seems that there is an issue with the server's stripe configuration. In case of failure, the amount will get refunded to your account."
+                    ),
+                ),
+                "status": 401,
+            }
+
+    def charge_saved_card(self, card) -> dict[str, Any]:
+        self.charge = {}
+
+        # La clave solo cambia tras un rechazo: dos envios del mismo intento comparten
+        # clave y Stripe no cobra dos veces
+        attempt = frappe.db.count(
+            "Integration Request",
+            {
+                "integration_request_service": "Stripe",
+                "reference_doctype": self.data.reference_doctype,
+                "reference_docname": self.data.reference_docname,
+                "status": "Failed",
+            },
+        )
+        amount = cint(flt(self.data.amount) * 100)
+
+        try:
+            self.charge = self.client.PaymentIntent.create(
+                customer=card.stripe_customer_id,
+                payment_method=card.stripe_payment_id,
+                amount=amount,
+                currency=self.data.currency,
+                description=self.data.description,
+                receipt_email=self.data.payer_email,
+                off_session=True,
+                confirm=True,
+                idempotency_key=(
+                    f"saved-card-{self.data.reference_docname}-{card.name}"
+                    f"-{amount}-{attempt}"
+                ),
+            )
+
+            if self.charge.status == "succeeded":
+                self.integration_request.db_set(
+                    "status", "Completed", update_modified=False
+                )
+                self.flags.status_changed_to = "Completed"
+
+        except stripe.error.CardError as e:
+            # p.ej. tarjeta rechazada o el banco requiere autenticar al cliente
+            self.charge = e.error.get("payment_intent") or {}
+            self.integration_request.db_set("status", "Failed", update_modified=False)
+            frappe.log_error(
+                title=f"Stripe Payment not completed {self.data.reference_docname}",
+                message=e.user_message,
+            )
+
+        self.save_stripe_response()
+
+        return self.finalize_request()
+
     def create_charge_on_stripe(self) -> dict[str, Any]:
         try:
             # Si el usuario marco que desea guardar el metodo de pago
@@ -246,7 +348,7 @@ class StripeSettings(Document):
                     and status_response_stripe
                 ):
                     # Se retoma el proceso de cobro y se realiza el cargo
-                    self.charge = stripe.PaymentIntent.create(
+                    self.charge = self.client.PaymentIntent.create(
                         customer=self.stripe_customer.id,
                         amount=cint(
                             flt(self.data.amount) * 100
@@ -275,7 +377,7 @@ class StripeSettings(Document):
             # Si el usuario no marco que desear guardar el metodo de pago
             # se procede con el proceso normal de cobro
             else:
-                self.charge = stripe.Charge.create(
+                self.charge = self.client.Charge.create(
                     amount=cint(flt(self.data.amount) * 100),
                     currency=self.data.currency,
                     source=self.data.stripe_token_id,
@@ -362,85 +464,88 @@ class StripeSettings(Document):
             self.stripe_customer = {}
             self.stripe_payment_method = {}
 
-            pk_customer = frappe.db.get_value(
-                "Payment Request", self.data.order_id, "party"
-            )
-
             # Debe existir un cliente con usuario paygate y activo
-            exists_customer_paygate = frappe.db.get_value(
-                "Customer",
-                filters={
-                    "name": pk_customer,
-                    "is_frozen": 0,
-                    "disabled": 0,
-                    "custom_paygate_user": ["!=", ""],
-                },
-                fieldname=["name", "custom_paygate_user"],
-                as_dict=True,
-            )
-
-            if not exists_customer_paygate:
+            paygate_customer = get_paygate_customer(self.data.order_id, self.name)
+            if not paygate_customer:
                 return False
 
-            if not exists_customer_paygate.custom_paygate_user:
-                return False
+            pk_customer = paygate_customer.customer
+            frappe.set_user(paygate_customer.custom_paygate_user)
 
-            if not frappe.db.exists(
-                "User",
-                {"name": exists_customer_paygate.custom_paygate_user, "enabled": 1},
-            ):
-                return False
-
-            frappe.set_user(exists_customer_paygate.custom_paygate_user)
-
-            stripe.api_key = self.get_password(
-                fieldname="secret_key", raise_exception=False
-            )
+            # Cliente de Stripe ya registrado en una tarjeta guardada
+            if paygate_customer.stripe_customer_id:
+                self.stripe_customer = frappe._dict(
+                    id=paygate_customer.stripe_customer_id
+                )
 
-            # Si ya existe un cliente en Stripe con el email, se usara
-            customers = stripe.Customer.list(
-                email=exists_customer_paygate.custom_paygate_user
-            ).auto_paging_iter()
+            else:
+                # Si ya existe un cliente en Stripe con el email, se usara
+                customers = self.client.Customer.list(
+                    email=paygate_customer.custom_paygate_user
+                ).auto_paging_iter()
 
-            self.stripe_customer = next(customers, None)
+                self.stripe_customer = next(customers, None)
 
             # Si no existe un cliente con el email, se crea
             if self.stripe_customer is None:
-                self.stripe_customer = stripe.Customer.create(
-                    email=exists_customer_paygate.custom_paygate_user,
+                self.stripe_customer = self.client.Customer.create(
+                    email=paygate_customer.custom_paygate_user,
                     name=pk_customer,
                     description="Cliente creado desde ERPNext",
                 )
+                # un cliente nuevo no tiene formas de pago
+                PaymentMethodIndex(self.name, self.stripe_customer.id).set_loaded()
 
-            # Crear y asociar un método de pago al cliente
-            self.stripe_payment_method = stripe.PaymentMethod.create(
-                type="card",
-                card={
-                    "token": self.data.stripe_token_id,
-                },
-            )
+            # La huella de la tarjeta se lee del token, sin crear aun la forma de pago
+            fingerprint = self.client.Token.retrieve(
+                self.data.stripe_token_id
+            ).card.fingerprint
 
-            # ya existe el metodo de pago en stripe?
-            payment_method_exists = self.is_payment_method_attached_(
-                str(self.stripe_payment_method.id), str(self.stripe_customer.id)
+            # ya existe la tarjeta asociada al cliente en stripe?
+            attached_payment_method = self.get_attached_payment_method(
+                self.stripe_customer.id, fingerprint
             )
 
-            # Si la forma de pago no esta asociada al cliente, se asocia
-            if not payment_method_exists:
-                # Al cliente se le adjunta la forma de pago
-                stripe.PaymentMethod.attach(
+            if attached_payment_method:
+                # Se cobra con la forma de pago ya asociada al cliente
+                self.stripe_payment_method = frappe._dict(id=attached_payment_method)
+                logger.info(
+                    "payment_method_already_attached",
+                    customer=self.stripe_customer.id,
+                    payment_method=attached_payment_method,
+                )
+
+            else:
+                # Crear y asociar un método de pago al cliente
+                self.stripe_payment_method = self.client.PaymentMethod.create(
+                    type="card",
+                    card={
+                        "token": self.data.stripe_token_id,
+                    },
+                )
+                self.client.PaymentMethod.attach(
                     self.stripe_payment_method.id,
                     customer=self.stripe_customer.id,
                 )
+                PaymentMethodIndex(self.name, self.stripe_customer.id).add(
+                    fingerprint, self.stripe_payment_method.id
+                )
 
-                # Registramos la tarjeta en el ERP para futuros usos
+            # Registramos la tarjeta en el ERP para futuros usos, si aun no lo esta
+            if not frappe.db.exists(
+                "PayGate Card",
+                {
+                    "stripe_customer_id": self.stripe_customer.id,
+                    "stripe_payment_id": self.stripe_payment_method.id,
+                },
+            ):
                 frappe.get_doc(
                     {
                         "doctype": "PayGate Card",
                         "customer": pk_customer,
                         "token_temp": "",
                         "is_default": 1,
-                        "email": exists_customer_paygate.custom_paygate_user,
+                        "email": paygate_customer.custom_paygate_user,
                         "gateway": "Stripe",
                         "process_data": 0,
                         "stripe_customer_id": self.stripe_customer.id,
@@ -461,12 +566,6 @@ class StripeSettings(Document):
                     }
                 ).insert(ignore_permissions=True)
 
-            else:
-                frappe.log_error(
-                    title="forma pago ya existe",
-                    message="forma de pago ya existe en el cliente",
-                )
-
             return True
 
         except Exception:
@@ -480,109 +579,76 @@ class StripeSettings(Document):
     def save_stripe_response(self) -> None:
         try:
             self.payment_req_ref = self.data.get("reference_docname")
+            response_log = None
+            receipt_url = None
 
             # Se hizo cuando el usuario marco que desea guardar el metodo de pago
             if self.charge.get("object") == "payment_intent":
-                new_res_log = frappe.get_doc(
-                    {
-                        "doctype": "PayGate Response Log",
-                        "gateway": "Stripe",
-                        "ref_to_payment_request": self.payment_req_ref or "",
-                        "payment_stripe_is_paid": 1
-                        if self.charge.get("status") == "succeeded"
-                        else 0,
-                        "payment_stripe_id": self.charge.get("id"),
-                        "amount": flt(self.charge.get("amount") / 100),
-                        "amount_captured": flt(
-                            self.charge.get("charges")
-                            .get("data")[0]
-                            .get("amount_captured")
-                            / 100
-                        ),
-                        "amount_refunded": flt(
-                            self.charge.get("charges")
-                            .get("data")[0]
-                            .get("amount_refunded")
-                            / 100
-                        ),
-                        "stripe_receipt_email": self.charge.get("receipt_email"),
-                        # "stripe_receipt_number": self.charge.get("receipt_number"),
-                        "stripe_currency": self.charge.get("charges")
-                        .get("data")[0]
-                        .get("currency")
-                        .upper(),
-                        "stripe_receipt_url": self.charge.get("charges")
-                        .get("data")[0]
-                        .get("receipt_url", "/stripe/payment-ok"),
-                        "stripe_response": json.dumps(
-                            self.charge, indent=2, default=str
-                        ),
-                    }
-                )
-                new_res_log.insert(ignore_permissions=True)
+                charge = self.charge.get("charges").get("data")[0]
+                response_log = {
+                    "payment_stripe_is_paid": 1
+                    if self.charge.get("status") == "succeeded"
+                    else 0,
+                    "amount_captured": flt(charge.get("amount_captured") / 100),
+                    "amount_refunded": flt(charge.get("amount_refunded") / 100),
+                    # "stripe_receipt_number": self.charge.get("receipt_number"),
+                    "stripe_currency": charge.get("currency").upper(),
+                    "stripe_receipt_url": charge.get(
+                        "receipt_url", "/stripe/payment-ok"
+                    ),
+                }
 
                 if self.charge.get("status") == "succeeded":
-                    self.redirect_url = (
-                        self.charge.get("charges")
-                        .get("data")[0]
-                        .get("receipt_url", "/stripe/payment-ok")
-                    )
-
-                    self.set_url_sucess_payment(
-                        self.charge.get("charges")
-                        .get("data")[0]
-                        .get("receipt_url", "/stripe/payment-ok")
-                    )
-                    self.set_payment_request_as_paid(self.payment_req_ref)
-
-                    return (
-                        self.charge.get("charges")
-                        .get("data")[0]
-                        .get("receipt_url", "/stripe/payment-ok")
-                    )
+                    receipt_url = charge.get("receipt_url", "/stripe/payment-ok")
 
             # Se hizo cuando el usuario no marco que desea guardar el metodo de pago
             if self.charge.get("object") == "charge":
-                new_res_log = frappe.get_doc(
-                    {
-                        "doctype": "PayGate Response Log",
-                        "gateway": "Stripe",
-                        "ref_to_payment_request": self.payment_req_ref or "",
-                        "payment_stripe_is_paid": self.charge.get("captured"),
-                        "payment_stripe_id": self.charge.get("id"),
-                        "amount": flt(self.charge.get("amount") / 100),
-                        "amount_captured": flt(
-                            self.charge.get("amount_captured") / 100
-                        ),
-                        "amount_refunded": flt(
-                            self.charge.get("amount_refunded") / 100
-                        ),
-                        "stripe_receipt_email": self.charge.get("receipt_email"),
-                        "stripe_receipt_number": self.charge.get("receipt_number"),
-                        "stripe_currency": self.charge.get("currency").upper(),
-                        "stripe_receipt_url": self.charge.get(
-                            "receipt_url", "/stripe/payment-ok"
-                        ),
-                        "stripe_response": json.dumps(
-                            self.charge, indent=2, default=str
-                        ),
-                    }
-                )
-                new_res_log.insert(ignore_permissions=True)
+                response_log = {
+                    "payment_stripe_is_paid": self.charge.get("captured"),
+                    "amount_captured": flt(self.charge.get("amount_captured") / 100),
+                    "amount_refunded": flt(self.charge.get("amount_refunded") / 100),
+                    "stripe_receipt_number": self.charge.get("receipt_number"),
+                    "stripe_currency": self.charge.get("currency").upper(),
+                    "stripe_receipt_url": self.charge.get(
+                        "receipt_url", "/stripe/payment-ok"
+                    ),
+                }
 
                 if self.charge.get("captured"):
-                    self.redirect_url = self.charge.get(
-                        "receipt_url", "/stripe/payment-ok"
-                    )
+                    receipt_url = self.charge.get("receipt_url", "/stripe/payment-ok")
+
+            if not response_log:
+                return "payment-failed"
+
+            response_log.update(
+                {
+                    "doctype": "PayGate Response Log",
+                    "gateway": "Stripe",
+                    "ref_to_payment_request": self.payment_req_ref or "",
+                    "payment_stripe_id": self.charge.get("id"),
+                    "amount": flt(self.charge.get("amount") / 100),
+                    "stripe_receipt_email": self.charge.get("receipt_email"),
+                    "stripe_response": encode_payload(self.charge),
+                }
+            )
 
-                    self.set_url_sucess_payment(
-                        self.charge.get("receipt_url", "/stripe/payment-ok")
-                    )
-                    self.set_payment_request_as_paid(self.payment_req_ref)
+            # El log y la URL del recibo se guardan en segundo plano, despues del commit
+            frappe.enqueue(
+                "payments.payment_gateways.doctype.stripe_settings.stripe_settings.save_stripe_response_log",
+                queue="short",
+                enqueue_after_commit=True,
+                response_log=response_log,
+                payment_request=self.payment_req_ref,
+                receipt_url=receipt_url,
+            )
 
-                    return self.charge.get("receipt_url", "/stripe/payment-ok")
+            if not receipt_url:
+                return "payment-failed"
 
-            return "payment-failed"
+            self.redirect_url = receipt_url
+            self.set_payment_request_as_paid(self.payment_req_ref)
+
+            return receipt_url
 
         except Exception:
             frappe.log_error(
@@ -590,22 +656,6 @@ class StripeSettings(Document):
             )
             return "payment-failed"
 
-    def set_url_sucess_payment(self, url):
-        try:
-            frappe.db.set_value(
-                "Payment Request",
-                self.payment_req_ref,
-                "pay_gate_visanet_token_ok_payment",
-                url,
-            )
-            frappe.db.commit()
-
-        except Exception:
-            frappe.log_error(
-                title="Error guardar URL de pago exitoso",
-                message=frappe.get_traceback(),
-            )
-
     def set_payment_request_as_paid(self, payment_request):
         try:
             if not payment_request:
@@ -620,28 +670,281 @@ class StripeSettings(Document):
                 message=frappe.get_traceback(),
             )
 
-    def is_payment_method_attached_(
-        self, payment_method_id: str, customer_id: str
-    ) -> bool:
+    def get_attached_payment_method(
+        self, customer_id: str, fingerprint: str
+    ) -> str | None:
+        """
+        Devuelve el id de la forma de pago del cliente para la tarjeta (por su huella),
+        usando el indice local. Solo se confia en una entrada registrada en PayGate Card;
+        si no lo esta, o el indice no esta cargado, se consulta Stripe.
+        """
         try:
-            payment_methods = stripe.PaymentMethod.list(customer=customer_id)
-            for pm in payment_methods.data:
-                if pm.id == payment_method_id:
-                    return True
+            index = PaymentMethodIndex(self.name, customer_id)
+
+            payment_method = index.get(fingerprint)
+            if payment_method and frappe.db.exists(
+                "PayGate Card",
+                {
+                    "stripe_customer_id": customer_id,
+                    "stripe_payment_id": payment_method,
+                },
+            ):
+                return payment_method
 
-            return False
+            if index.is_loaded() and not payment_method:
+                return None
+
+            index.load(
+                self.client.PaymentMethod.list(
+                    customer=customer_id, type="card"
+                ).auto_paging_iter()
+            )
+            return index.get(fingerprint)
 
         except Exception:
             frappe.log_error(
                 title="Error is payment method attached", message=frappe.get_traceback()
             )
-            return False
+            return None
+
+
+def get_paygate_customer(payment_request: str, gateway_controller: str) -> dict | None:
+    """
+    Return the active Customer of a Payment Request with an enabled paygate user and,
+    if a card was saved before with this Stripe account, its Stripe customer id.
+    """
+    payment_request_dt = frappe.qb.DocType("Payment Request")
+    customer = frappe.qb.DocType("Customer")
+    user = frappe.qb.DocType("User")
+    card = frappe.qb.DocType("PayGate Card")
+
+    result = (
+        frappe.qb.from_(payment_request_dt)
+        .join(customer)
+        .on(customer.name == payment_request_dt.party)
+        .join(user)
+        .on(user.name == customer.custom_paygate_user)
+        .left_join(card)
+        .on(
+            (card.customer == customer.name)
+            & (card.gateway == "Stripe")
+            & (card.gateway_setting_name == gateway_controller)
+            & card.stripe_customer_id.isnotnull()
+        )
+        .select(
+            customer.name.as_("customer"),
+            customer.custom_paygate_user,
+            card.stripe_customer_id,
+        )
+        .where(
+            (payment_request_dt.name == payment_request)
+            & (customer.is_frozen == 0)
+            & (customer.disabled == 0)
+            & (customer.custom_paygate_user != "")
+            & (user.enabled == 1)
+        )
+        .orderby(card.creation, order=frappe.qb.desc)
+        .limit(1)
+    ).run(as_dict=True)
+
+    return result[0] if result else None
+
+
+class PaymentMethodIndex:
+    """
+    Card fingerprint to PaymentMethod id of one Stripe customer, kept in Redis so that
+    tokenized checkouts don't page through `PaymentMethod.list` on every payment.
+
+    Once loaded from Stripe the index is complete: cards attached by this app are added
+    as they are attached, so a missing fingerprint means a new card. Cards detached
+    outside this app are only noticed when the index expires and is loaded again.
+    """
+
+    LOADED = "__loaded__"
+    TTL = 86400
+
+    def __init__(self, gateway_controller: str, customer_id: str):
+        self.key = f"stripe_payment_methods|{gateway_controller}|{customer_id}"
+
+    def get(self, fingerprint: str) -> str | None:
+        return frappe.cache().hget(self.key, fingerprint)
+
+    def add(self, fingerprint: str, payment_method: str) -> None:
+        frappe.cache().hset(self.key, fingerprint, payment_method)
+        self.set_expiry()
+
+    def is_loaded(self) -> bool:
+        return bool(frappe.cache().hget(self.key, self.LOADED))
+
+    def set_loaded(self) -> None:
+        frappe.cache().hset(self.key, self.LOADED, 1)
+        self.set_expiry()
+
+    def set_expiry(self) -> None:
+        frappe.cache().expire(frappe.cache().make_key(self.key), self.TTL)
+
+    def load(self, payment_methods) -> None:
+        frappe.cache().delete_value(self.key)
+        for payment_method in payment_methods:
+            frappe.cache().hset(
+                self.key, payment_method.card.fingerprint, payment_method.id
+            )
+
+        self.set_loaded()
+
+
+def save_stripe_response_log(
+    response_log: dict,
+    payment_request: str | None = None,
+    receipt_url: str | None = None,
+) -> None:
+    """
+    Write-behind part of `StripeSettings.save_stripe_response`: inserts the PayGate
+    Response Log and stores the receipt URL on the Payment Request. Runs as a background
+    job enqueued once the payment is committed, so the buyer's redirect does not wait
+    for it; a failed job stays in the queue's failed registry and can be requeued.
+    """
+    frappe.get_doc(response_log).insert(ignore_permissions=True)
+
+    if payment_request and receipt_url:
+        frappe.db.set_value(
+            "Payment Request",
+            payment_request,
+            "pay_gate_visanet_token_ok_payment",
+            receipt_url,
+        )
 
 
 def get_gateway_controller(doctype, docname) -> str:
-    # reference_doc = frappe.get_doc(doctype, docname)
-    reference_doc = frappe.db.get_value(doctype, docname, "payment_gateway")
-    gateway_controller = frappe.db.get_value(
-        "Payment Gateway", reference_doc, "gateway_controller"
+    return get_reference_gateway_controller(doctype, docname)
+
+
+class StripeClient:
+    """
+    Stripe API bound to the secret key of one Stripe Settings document.
+
+    The key is passed with every call instead of being assigned to the module-global
+    `stripe.api_key`, so requests for different accounts served concurrently by a
+    threaded or gevent worker cannot charge against each other's account.
+
+    Usage mirrors the stripe module: `client.PaymentIntent.create(amount=...)`
+    """
+
+    def __init__(self, api_key: str):
+        self.api_key = api_key
+        self.http_client = get_http_client()
+        set_default_http_client()
+
+    def __getattr__(self, resource: str) -> "StripeResource":
+        if resource.startswith("_"):
+            raise AttributeError(resource)
+
+        return StripeResource(getattr(stripe, resource), self.api_key, self.http_client)
+
+
+class StripeResource:
+    def __init__(self, resource, api_key: str, http_client=None):
+        self.resource = resource
+        self.api_key = api_key
+        self.http_client = http_client
+
+    def __getattr__(self, method: str):
+        operation = getattr(self.resource, method)
+
+        def call(*args, **params):
+            previous = getattr(_active_http_client, "client", None)
+            _active_http_client.client = self.http_client
+            try:
+                return operation(*args, api_key=self.api_key, **params)
+            finally:
+                _active_http_client.client = previous
+
+        return call
+
+
+def get_stripe_client(gateway_controller: str) -> StripeClient:
+    """Return the cached client of a Stripe Settings document, rebuilt when it is saved"""
+    return get_settings_cache(
+        "Stripe Settings",
+        gateway_controller,
+        "client",
+        lambda: StripeClient(
+            get_decrypted_password(
+                "Stripe Settings",
+                gateway_controller,
+                "secret_key",
+                raise_exception=False,
+            )
+        ),
+    )
+
+
+def get_checkout_settings(gateway_controller: str) -> frappe._dict:
+    """Return the checkout page display settings, cached until the settings are saved"""
+    return get_settings_cache(
+        "Stripe Settings",
+        gateway_controller,
+        "checkout_settings",
+        lambda: load_checkout_settings(gateway_controller),
     )
-    return gateway_controller
+
+
+def load_checkout_settings(gateway_controller: str) -> frappe._dict:
+    # `custom_enable_tokenization` is a custom field and may not be installed
+    fields = ["publishable_key", "header_img"]
+    if frappe.get_meta("Stripe Settings").has_field("custom_enable_tokenization"):
+        fields.append("custom_enable_tokenization")
+
+    settings = frappe.db.get_value(
+        "Stripe Settings", gateway_controller, fields, as_dict=True
+    )
+    settings = settings or frappe._dict()
+
+    return frappe._dict(
+        publishable_key=settings.publishable_key,
+        header_image=get_header_image_url(settings.header_img),
+        is_tokenization_enabled=cint(settings.custom_enable_tokenization),
+    )
+
+
+def get_header_image_url(header_image: str) -> str:
+    if not header_image:
+        return ""
+
+    parsed_url = urllib.parse.urlparse(header_image)
+    encoded_path = urllib.parse.quote(parsed_url.path)
+    return f"{parsed_url.scheme}://{parsed_url.netloc}{encoded_path}"
+
+
+class SiteHTTPClient:
+    """
+    HTTP client of the stripe library sending each request through the pooled client of
+    the site being served, with that site's session and timeouts.
+
+    Calls made through a `StripeClient` use the client it was created with.
+    """
+
+    name = "requests"
+
+    def __getattr__(self, attr: str):
+        client = getattr(_active_http_client, "client", None) or get_http_client()
+        return getattr(client, attr)
+
+
+def set_default_http_client() -> None:
+    """Make the stripe library use the pooled HTTP client of the current site"""
+    if not isinstance(stripe.default_http_client, SiteHTTPClient):
+        stripe.default_http_client = SiteHTTPClient()
+
+
+def get_http_client() -> stripe.http_client.RequestsClient:
+    site = frappe.local.site
+    if site not in _http_clients:
+        with _http_client_lock:
+            if site not in _http_clients:
+                _http_clients[site] = stripe.http_client.RequestsClient(
+                    timeout=get_timeout("Stripe"),
+                    session=get_session("Stripe", stripe.api_base),
+                )
+
+    return _http_clients[site]
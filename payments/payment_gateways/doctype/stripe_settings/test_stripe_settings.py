@@ -1,7 +1,81 @@
 # Copyright (c) 2018, Frappe Technologies and Contributors
 # License: MIT. See LICENSE
+import json
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import stripe
+
+from payments.payment_gateways.doctype.stripe_settings.stripe_settings import StripeClient
 
 
 class TestStripeSettings(unittest.TestCase):
-	pass
+	def setUp(self):
+		self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubStripeHandler)
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+		self.api_base = stripe.api_base
+		stripe.api_base = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+	def tearDown(self):
+		stripe.api_base = self.api_base
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_concurrent_charges_use_their_own_account(self):
+		clients = {f"sk_test_account_{i}": StripeClient(f"sk_test_account_{i}") for i in range(4)}
+
+		def charge(account):
+			return account, clients[account].Charge.create(
+				amount=1000,
+				currency="usd",
+				source="tok_visa",
+				metadata={"account": account},
+			)
+
+		with ThreadPoolExecutor(max_workers=16) as executor:
+			futures = [executor.submit(charge, account) for account in clients for _ in range(25)]
+			results = [future.result() for future in futures]
+
+		self.assertEqual(len(results), 100)
+		for account, result in results:
+			# the stub echoes back the key the request was authenticated with
+			self.assertEqual(result.metadata["account"], account)
+			self.assertEqual(result.charged_with, account)
+
+		# the module-global key is never touched
+		self.assertIsNone(stripe.api_key)
+
+
+class StubStripeHandler(BaseHTTPRequestHandler):
+	"""Minimal stand-in for `POST /v1/charges` that echoes the authenticating key."""
+
+	def do_POST(self):
+		body = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+		api_key = self.headers["Authorization"].split(" ", 1)[1]
+
+		# widen the window for requests of different accounts to interleave
+		time.sleep(0.01)
+
+		payload = json.dumps(
+			{
+				"id": "ch_stub",
+				"object": "charge",
+				"captured": True,
+				"charged_with": api_key,
+				"metadata": {"account": body["metadata[account]"][0]},
+			}
+		).encode()
+
+		self.send_response(200)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(payload)))
+		self.end_headers()
+		self.wfile.write(payload)
+
+	def log_message(self, *args):
+		pass
@@ -0,0 +1,258 @@
+# Copyright (c) 2018, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""
+Billing runs: charge a set of Payment Requests to the default PayGate Card of their
+customers, off-session and in parallel, without going through the checkout page.
+
+	bench --site <site> execute payments.payment_gateways.stripe_billing.start_billing_run \
+		--kwargs "{'payment_requests': ['ACC-PRQ-2024-00001', 'ACC-PRQ-2024-00002']}"
+
+Every charge uses the idempotency key `billing-{run}-{payment request}` and progress is
+checkpointed per batch, so a run that crashed can be started again with the same run id
+within a day: finished Payment Requests are skipped and a charge that was sent but not
+recorded is returned by Stripe instead of being made twice.
+
+Charges are made in parallel, `stripe_billing_workers` at a time (8 by default), and
+throttled by the Stripe rate limiter of each account (see `payments.utils.rate_limiter`).
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import frappe
+import stripe
+from frappe import _
+from frappe.utils import cint, flt
+
+from payments.payment_gateways.doctype.stripe_settings.stripe_settings import get_stripe_client
+from payments.utils import create_request_logs
+from payments.utils.logger import get_logger
+
+BILLING_BATCH_SIZE = 100
+BILLING_WORKERS = 8
+# an unfinished run can be resumed for as long as Stripe keeps its idempotency keys
+BILLING_CHECKPOINT_EXPIRY = 86400
+
+logger = get_logger("Stripe")
+
+
+@frappe.whitelist()
+def start_billing_run(payment_requests, run_id=None):
+	"""Enqueue a billing run for the Payment Requests and return its id"""
+	frappe.only_for("System Manager")
+
+	run_id = run_id or frappe.generate_hash(length=10)
+	frappe.enqueue(
+		"payments.payment_gateways.stripe_billing.run_billing",
+		queue="long",
+		timeout=6 * 3600,
+		job_id=f"stripe_billing_run::{run_id}",
+		deduplicate=True,
+		run_id=run_id,
+		payment_requests=frappe.parse_json(payment_requests),
+	)
+
+	return run_id
+
+
+def run_billing(run_id, payment_requests):
+	"""Charge the Payment Requests of a billing run and return its statistics"""
+	checkpoint = BillingCheckpoint(run_id)
+	done = checkpoint.get_done()
+	pending = [name for name in payment_requests if name not in done]
+
+	stats = frappe._dict(
+		run_id=run_id, charged=0, failed=0, skipped=0, resumed=len(payment_requests) - len(pending)
+	)
+	failures = {}
+	clients = {}
+	started = time.monotonic()
+
+	with ThreadPoolExecutor(
+		max_workers=cint(frappe.conf.stripe_billing_workers) or BILLING_WORKERS
+	) as executor:
+		for start in range(0, len(pending), BILLING_BATCH_SIZE):
+			batch = pending[start : start + BILLING_BATCH_SIZE]
+			rows = get_billable_payment_requests(batch)
+			stats.skipped += len(batch) - len(rows)
+
+			# clients are per Stripe account, prepared outside the threads
+			for row in rows:
+				if row.gateway_controller not in clients:
+					clients[row.gateway_controller] = get_stripe_client(row.gateway_controller)
+
+			results = list(
+				executor.map(
+					lambda row: charge_payment_request(
+						row, clients[row.gateway_controller], run_id
+					),
+					rows,
+				)
+			)
+
+			for reason in write_billing_results(run_id, results):
+				if reason:
+					stats.failed += 1
+					failures[reason] = failures.get(reason, 0) + 1
+				else:
+					stats.charged += 1
+
+			frappe.db.commit()
+			checkpoint.add(batch)
+
+	stats.elapsed = round(time.monotonic() - started, 3)
+	stats.charges_per_second = round(stats.charged / stats.elapsed, 2) if stats.elapsed else 0
+	stats.failures = failures
+
+	checkpoint.complete(stats)
+	logger.info("billing_run_completed", **stats)
+	frappe.publish_realtime("stripe_billing_run", stats, user=frappe.session.user)
+
+	return stats
+
+
+def get_billable_payment_requests(names):
+	"""Return the unpaid Payment Requests among `names` with a default Stripe card to charge"""
+	payment_request = frappe.qb.DocType("Payment Request")
+	gateway = frappe.qb.DocType("Payment Gateway")
+	card = frappe.qb.DocType("PayGate Card")
+
+	rows = (
+		frappe.qb.from_(payment_request)
+		.join(gateway)
+		.on(gateway.name == payment_request.payment_gateway)
+		.join(card)
+		.on(
+			(card.customer == payment_request.party)
+			& (card.gateway == "Stripe")
+			& (card.gateway_setting_name == gateway.gateway_controller)
+			& (card.is_default == 1)
+		)
+		.select(
+			payment_request.name,
+			payment_request.grand_total,
+			payment_request.currency,
+			payment_request.subject,
+			payment_request.email_to,
+			gateway.gateway_controller,
+			card.stripe_customer_id,
+			card.stripe_payment_id,
+		)
+		.where(
+			payment_request.name.isin(names)
+			& (payment_request.docstatus == 1)
+			& payment_request.status.notin(["Paid", "Cancelled"])
+			& card.stripe_customer_id.isnotnull()
+			& card.stripe_payment_id.isnotnull()
+		)
+		.orderby(card.modified, order=frappe.qb.desc)
+	).run(as_dict=True)
+
+	# the most recent default card per Payment Request
+	billable = {}
+	for row in rows:
+		billable.setdefault(row.name, row)
+
+	return list(billable.values())
+
+
+def charge_payment_request(row, client, run_id):
+	"""Charge one Payment Request, runs in a worker thread and must not touch the database.
+
+	Returns `(row, payment_intent, failure_reason, message)`.
+	"""
+	try:
+		payment_intent = client.PaymentIntent.create(
+			customer=row.stripe_customer_id,
+			payment_method=row.stripe_payment_id,
+			amount=cint(flt(row.grand_total) * 100),
+			currency=row.currency,
+			description=row.subject,
+			receipt_email=row.email_to,
+			off_session=True,
+			confirm=True,
+			metadata={"payment_request": row.name, "billing_run": run_id},
+			idempotency_key=get_idempotency_key(run_id, row.name),
+		)
+	except stripe.error.CardError as e:
+		reason = e.error.get("decline_code") or e.code or "card_error"
+		return row, e.error.get("payment_intent"), reason, e.user_message
+	except stripe.error.StripeError as e:
+		return row, None, e.code or type(e).__name__, str(e)
+	except Exception as e:
+		return row, None, type(e).__name__, str(e)
+
+	if payment_intent.status != "succeeded":
+		return row, payment_intent, payment_intent.status, None
+
+	return row, payment_intent, None, None
+
+
+def write_billing_results(run_id, results):
+	"""Log a batch of charges and mark the charged Payment Requests as paid.
+
+	Returns the failure reason of each result, `None` for successful charges.
+	"""
+	logs, reasons = [], []
+
+	for row, payment_intent, reason, message in results:
+		if not reason:
+			frappe.db.savepoint("stripe_billing")
+			try:
+				frappe.get_doc("Payment Request", row.name).set_as_paid()
+			except Exception:
+				frappe.db.rollback(save_point="stripe_billing")
+				frappe.log_error(
+					title=_("Stripe billing run {0}: {1} not marked as paid").format(
+						run_id, row.name
+					)
+				)
+				reason, message = "not_marked_as_paid", frappe.get_traceback()
+
+		logs.append(
+			{
+				"name": get_idempotency_key(run_id, row.name),
+				"status": "Failed" if reason else "Completed",
+				"data": {
+					"reference_doctype": "Payment Request",
+					"reference_docname": row.name,
+					"amount": row.grand_total,
+					"currency": row.currency,
+					"billing_run": run_id,
+				},
+				"output": payment_intent,
+				"error": {"reason": reason, "message": message} if reason else None,
+			}
+		)
+		reasons.append(reason)
+
+	create_request_logs("Stripe", logs)
+	return reasons
+
+
+def get_idempotency_key(run_id, payment_request):
+	return f"billing-{run_id}-{payment_request}"
+
+
+class BillingCheckpoint:
+	"""Payment Requests already processed by a billing run, kept in Redis"""
+
+	def __init__(self, run_id):
+		self.key = f"stripe_billing_run|{run_id}"
+
+	def get_done(self):
+		return set(frappe.cache().hgetall(self.key) or {})
+
+	def add(self, payment_requests):
+		for name in payment_requests:
+			frappe.cache().hset(self.key, name, 1)
+
+		frappe.cache().expire(frappe.cache().make_key(self.key), BILLING_CHECKPOINT_EXPIRY)
+
+	def complete(self, stats):
+		"""Drop the processed Payment Requests and keep the statistics of the finished run"""
+		frappe.cache().delete_value(self.key)
+		frappe.cache().set_value(
+			f"{self.key}|stats", stats, expires_in_sec=BILLING_CHECKPOINT_EXPIRY
+		)
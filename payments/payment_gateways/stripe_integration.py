@@ -1,18 +1,18 @@
 # Copyright (c) 2018, Frappe Technologies Pvt. Ltd. and contributors
 # For license information, please see license.txt
 
-import stripe
 import frappe
 from frappe import _
 from frappe.integrations.utils import create_request_log
 
+from payments.payment_gateways.doctype.stripe_settings.stripe_settings import get_stripe_client
+
 
 def create_stripe_subscription(gateway_controller, data):
 	stripe_settings = frappe.get_doc("Stripe Settings", gateway_controller)
 	stripe_settings.data = frappe._dict(data)
 
-	stripe.api_key = stripe_settings.get_password(fieldname="secret_key", raise_exception=False)
-	stripe.default_http_client = stripe.http_client.RequestsClient()
+	stripe_settings.client = get_stripe_client(gateway_controller)
 
 	try:
 		stripe_settings.integration_request = create_request_log(stripe_settings.data, "Host", "Stripe")
@@ -41,13 +41,13 @@ def create_subscription_on_stripe(stripe_settings):
 		items.append({"price": plan, "quantity": payment_plan.qty})
 
 	try:
-		customer = stripe.Customer.create(
+		customer = stripe_settings.client.Customer.create(
 			source=stripe_settings.data.stripe_token_id,
 			description=stripe_settings.data.payer_name,
 			email=stripe_settings.data.payer_email,
 		)
 
-		subscription = stripe.Subscription.create(customer=customer, items=items)
+		subscription = stripe_settings.client.Subscription.create(customer=customer, items=items)
 
 		if subscription.status == "active":
 			stripe_settings.integration_request.db_set("status", "Completed", update_modified=False)
@@ -0,0 +1,167 @@
+# Copyright (c) 2018, Frappe Technologies Pvt. Ltd. and contributors
+# For license information, please see license.txt
+
+"""
+Batched processing of subscription notifications (Razorpay webhooks and PayPal IPNs).
+
+Webhooks only store the notification as a Queued Integration Request and call
+`enqueue_notification_processing`. One job at a time then drains the queued
+notifications in batches: events for the same subscription are collapsed into the
+latest one, which is verified with the gateway and handed to the
+`handle_subscription_notification` hook once per subscription and batch.
+
+The job runs on the `short` queue, or on the queue named by
+`payments_notification_queue` in site config (e.g. a dedicated worker queue), and the
+scheduler enqueues it regularly in case a notification was stored while a previous
+run was finishing.
+"""
+
+import frappe
+from frappe.utils import call_hook_method, now
+from redis.exceptions import LockError
+
+from payments.utils.codec import decode_payload
+
+NOTIFICATION_BATCH_SIZE = 200
+NOTIFICATION_LOCK_TIMEOUT = 300
+NOTIFICATION_QUEUE = "short"
+
+
+def enqueue_notification_processing():
+	"""Enqueue the notification processor, unless it is already waiting to run"""
+	frappe.enqueue(
+		"payments.payment_gateways.subscription_notifications.process_subscription_notifications",
+		queue=frappe.conf.payments_notification_queue or NOTIFICATION_QUEUE,
+		job_id="process_subscription_notifications",
+		deduplicate=True,
+		enqueue_after_commit=True,
+	)
+
+
+def process_subscription_notifications():
+	lock = frappe.cache().lock(
+		frappe.cache().make_key("process_subscription_notifications"),
+		timeout=NOTIFICATION_LOCK_TIMEOUT,
+	)
+	if not lock.acquire(blocking=False):
+		# the running job picks up what was queued in the meantime
+		return
+
+	try:
+		while batch := get_queued_notifications():
+			processed = process_batch(batch, lock)
+			frappe.db.commit()
+			if not processed:
+				break
+	finally:
+		try:
+			lock.release()
+		except LockError:
+			pass
+
+
+def get_queued_notifications():
+	return frappe.get_all(
+		"Integration Request",
+		filters={
+			"request_description": "Subscription Notification",
+			"integration_request_service": ["in", list(get_subscription_handlers())],
+			"status": "Queued",
+		},
+		fields=["name", "integration_request_service", "data"],
+		order_by="creation asc",
+		limit=NOTIFICATION_BATCH_SIZE,
+	)
+
+
+def get_subscription_handlers():
+	"""Return `(get_subscription_id, validate)` per gateway"""
+	from payments.payment_gateways.doctype.paypal_settings.paypal_settings import (
+		validate_ipn_request,
+	)
+	from payments.payment_gateways.doctype.razorpay_settings.razorpay_settings import (
+		validate_payment_callback,
+	)
+
+	return {
+		"PayPal": (lambda data: data.get("recurring_payment_id"), validate_ipn_request),
+		"Razorpay": (
+			lambda data: data.get("payload").get("subscription").get("entity").get("id"),
+			validate_payment_callback,
+		),
+	}
+
+
+def process_batch(batch, lock):
+	"""Process a batch of notifications, renewing `lock` before each subscription so it
+	can't expire while the gateway is being called.
+
+	Returns False if the lock was lost anyway; the rest of the batch is then left to the
+	run holding it now.
+	"""
+	handlers = get_subscription_handlers()
+
+	# notifications per subscription, oldest first
+	subscriptions = {}
+	completed, failed = [], {}
+	for notification in batch:
+		try:
+			data = decode_payload(notification.data)
+			get_subscription_id = handlers[notification.integration_request_service][0]
+		except Exception:
+			# malformed notification, fail it rather than every run
+			failed[notification.name] = {"error": frappe.get_traceback()}
+			continue
+
+		try:
+			subscription_id = get_subscription_id(data)
+		except AttributeError:
+			subscription_id = None
+
+		key = (notification.integration_request_service, subscription_id or notification.name)
+		subscriptions.setdefault(key, []).append((notification.name, data))
+
+	for (gateway, subscription_id), notifications in subscriptions.items():
+		latest, data = notifications[-1]
+		names = [name for name, _data in notifications]
+		validate = handlers[gateway][1]
+
+		try:
+			lock.reacquire()
+		except LockError:
+			update_notification_status(completed, failed)
+			return False
+
+		frappe.db.savepoint("subscription_notification")
+		try:
+			validate(data)
+			call_hook_method(
+				"handle_subscription_notification", doctype="Integration Request", docname=latest
+			)
+			completed.extend(names)
+		except frappe.InvalidStatusError:
+			frappe.db.rollback(save_point="subscription_notification")
+			failed.update({name: {"error": "Invalid Subscription"} for name in names})
+		except Exception:
+			frappe.db.rollback(save_point="subscription_notification")
+			frappe.log_error(title=f"{gateway} subscription notification {subscription_id}")
+			failed.update({name: {"error": frappe.get_traceback()} for name in names})
+
+	update_notification_status(completed, failed)
+	return True
+
+
+def update_notification_status(completed, failed):
+	if completed:
+		integration_request = frappe.qb.DocType("Integration Request")
+		(
+			frappe.qb.update(integration_request)
+			.set(integration_request.status, "Completed")
+			.set(integration_request.modified, now())
+			.where(integration_request.name.isin(completed))
+			# the hook may have set its own status
+			.where(integration_request.status == "Queued")
+		).run()
+
+	for name, error in failed.items():
+		frappe.get_doc("Integration Request", name).handle_failure(error)
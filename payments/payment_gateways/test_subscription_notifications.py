@@ -0,0 +1,79 @@
+# Copyright (c) 2024, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import json
+import unittest
+from unittest.mock import MagicMock, patch
+
+import frappe
+
+from payments.payment_gateways.subscription_notifications import process_batch
+
+
+def get_subscription_id(data):
+	return data.get("payload").get("subscription").get("entity").get("id")
+
+
+def validate(data):
+	if get_subscription_id(data) == "sub_invalid":
+		raise frappe.InvalidStatusError
+
+
+class TestSubscriptionNotifications(unittest.TestCase):
+	def setUp(self):
+		patcher = patch(
+			"payments.payment_gateways.subscription_notifications.get_subscription_handlers",
+			return_value={"Razorpay": (get_subscription_id, validate)},
+		)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_notifications_are_coalesced_per_subscription(self):
+		batch = [
+			insert_notification("sub_1", "subscription.activated"),
+			insert_notification("sub_invalid", "subscription.charged"),
+			insert_notification("sub_1", "subscription.charged"),
+			insert_notification("sub_2", "subscription.charged"),
+			insert_notification("sub_1", "subscription.halted"),
+		]
+
+		with patch(
+			"payments.payment_gateways.subscription_notifications.call_hook_method"
+		) as call_hook_method:
+			self.assertTrue(process_batch(batch, MagicMock()))
+
+		# once per subscription, with its latest notification
+		self.assertEqual(call_hook_method.call_count, 2)
+		self.assertEqual(
+			[call.kwargs["docname"] for call in call_hook_method.call_args_list],
+			[batch[4].name, batch[3].name],
+		)
+
+		statuses = [
+			frappe.db.get_value("Integration Request", notification.name, "status")
+			for notification in batch
+		]
+		self.assertEqual(statuses, ["Completed", "Failed", "Completed", "Completed", "Completed"])
+
+
+def insert_notification(subscription_id, event):
+	data = json.dumps(
+		{"event": event, "payload": {"subscription": {"entity": {"id": subscription_id}}}}
+	)
+	integration_request = frappe.get_doc(
+		{
+			"doctype": "Integration Request",
+			"integration_request_service": "Razorpay",
+			"request_description": "Subscription Notification",
+			"data": data,
+			"status": "Queued",
+		}
+	).insert(ignore_permissions=True)
+
+	return frappe._dict(
+		name=integration_request.name,
+		integration_request_service="Razorpay",
+		data=integration_request.data,
+	)
@@ -1,7 +1,5 @@
 # Copyright (c) 2021, Frappe Technologies Pvt. Ltd. and Contributors
 # License: MIT. See LICENSE
-import json
-
 import frappe
 from frappe import _
 
@@ -9,6 +7,7 @@ from payments.payment_gateways.doctype.paytm_settings.paytm_settings import (
 	get_paytm_config,
 	get_paytm_params,
 )
+from payments.utils.codec import decode_payload
 
 
 def get_context(context):
@@ -18,7 +17,9 @@ def get_context(context):
 	try:
 		doc = frappe.get_doc("Integration Request", frappe.form_dict["order_id"])
 
-		context.payment_details = get_paytm_params(json.loads(doc.data), doc.name, paytm_config)
+		context.payment_details = get_paytm_params(
+			decode_payload(doc.data), doc.name, paytm_config
+		)
 
 		context.url = paytm_config.url
 
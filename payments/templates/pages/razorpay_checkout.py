@@ -6,6 +6,9 @@ import frappe
 from frappe import _
 from frappe.utils import cint, flt
 
+from payments.utils import get_settings_snapshot
+from payments.utils.codec import decode_payload
+
 no_cache = 1
 
 expected_keys = (
@@ -27,7 +30,7 @@ def get_context(context):
 
 	try:
 		doc = frappe.get_doc("Integration Request", frappe.form_dict["token"])
-		payment_details = json.loads(doc.data)
+		payment_details = decode_payload(doc.data)
 
 		for key in expected_keys:
 			context[key] = payment_details[key]
@@ -51,7 +54,7 @@ def get_context(context):
 
 
 def get_api_key():
-	api_key = frappe.db.get_single_value("Razorpay Settings", "api_key")
+	api_key = get_settings_snapshot("Razorpay Settings").api_key
 	if cint(frappe.form_dict.get("use_sandbox")):
 		api_key = frappe.conf.sandbox_api_key
 
@@ -74,6 +77,6 @@ def make_payment(razorpay_payment_id, options, reference_doctype, reference_docn
 		}
 	)
 
-	data = frappe.get_doc("Razorpay Settings").create_request(data)
+	data = get_settings_snapshot("Razorpay Settings").create_request(data)
 	frappe.db.commit()
 	return data
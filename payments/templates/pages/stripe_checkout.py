@@ -1,18 +1,22 @@
 # Copyright (c) 2021, Frappe Technologies Pvt. Ltd. and Contributors
 # License: MIT. See LICENSE
 import json
-import urllib.parse
 
 import frappe
 from frappe import _
 from frappe.utils import cint, fmt_money
 
 from payments.payment_gateways.doctype.stripe_settings.stripe_settings import (
+    get_checkout_settings,
     get_gateway_controller,
 )
+from payments.utils import get_payment_gateway_settings
+from payments.utils.logger import get_logger
 
 no_cache = 1
 
+logger = get_logger("Stripe")
+
 expected_keys = (
     "amount",
     "title",
@@ -34,40 +38,34 @@ def get_context(context):
         for key in expected_keys:
             context[key] = frappe.form_dict[key]
 
+        checkout = get_checkout_context(
+            context.reference_doctype, context.reference_docname
+        )
+
         # Si el pago ya fue completado, se redirecciona a la url donde esta el voucher de pago
         validate_data_payment = verify_payment(
-            context.reference_doctype, context.reference_docname
+            context.reference_doctype, context.reference_docname, checkout
         )
         if validate_data_payment:
             frappe.local.response["type"] = "redirect"
             frappe.local.response["location"] = validate_data_payment.get("redirect_to")
             raise frappe.Redirect
 
-        gateway_controller = get_gateway_controller(
-            context.reference_doctype, context.reference_docname
-        )
+        gateway_controller = checkout.gateway_controller
+        settings = get_checkout_settings(gateway_controller)
 
         context.publishable_key = get_api_key(
             context.reference_docname, gateway_controller
         )
-
-        context.is_tokenization_enabled = frappe.db.get_value(
-            "Stripe Settings", gateway_controller, "custom_enable_tokenization"
-        )
-
-        context.image = get_header_image(context.reference_docname, gateway_controller)
+        context.is_tokenization_enabled = settings.is_tokenization_enabled
+        context.image = settings.header_image
 
         context["amount"] = fmt_money(
             amount=context["amount"], currency=context["currency"]
         )
 
-        if is_a_subscription(context.reference_doctype, context.reference_docname):
-            payment_plan = frappe.db.get_value(
-                context.reference_doctype, context.reference_docname, "payment_plan"
-            )
-            recurrence = frappe.db.get_value("Payment Plan", payment_plan, "recurrence")
-
-            context["amount"] = context["amount"] + " " + _(recurrence)
+        if checkout.is_a_subscription:
+            context["amount"] = context["amount"] + " " + _(checkout.recurrence)
 
     else:
         frappe.redirect_to_message(
@@ -80,10 +78,46 @@ def get_context(context):
         raise frappe.Redirect
 
 
-def get_api_key(doc, gateway_controller):
-    publishable_key = frappe.db.get_value(
-        "Stripe Settings", gateway_controller, "publishable_key"
+def get_checkout_context(reference_doctype, reference_docname):
+    """
+    Load what the checkout page needs from the reference document in a single query:
+    its payment status, the gateway controller and, for subscriptions, the recurrence
+    of the payment plan.
+    """
+    meta = frappe.get_meta(reference_doctype)
+    reference = frappe.qb.DocType(reference_doctype)
+    gateway = frappe.qb.DocType("Payment Gateway")
+
+    query = (
+        frappe.qb.from_(reference)
+        .left_join(gateway)
+        .on(gateway.name == reference.payment_gateway)
+        .select(reference.name, gateway.gateway_controller)
+        .where(reference.name == reference_docname)
     )
+
+    for fieldname in (
+        "status",
+        "pay_gate_visanet_token_ok_payment",
+        "is_a_subscription",
+    ):
+        if meta.has_field(fieldname):
+            query = query.select(reference[fieldname])
+
+    if meta.has_field("payment_plan"):
+        payment_plan = frappe.qb.DocType("Payment Plan")
+        query = (
+            query.left_join(payment_plan)
+            .on(payment_plan.name == reference.payment_plan)
+            .select(payment_plan.recurrence)
+        )
+
+    result = query.run(as_dict=True)
+    return result[0] if result else frappe._dict()
+
+
+def get_api_key(doc, gateway_controller):
+    publishable_key = get_checkout_settings(gateway_controller).publishable_key
     if cint(frappe.form_dict.get("use_sandbox")):
         publishable_key = frappe.conf.sandbox_publishable_key
 
@@ -91,17 +125,7 @@ def get_api_key(doc, gateway_controller):
 
 
 def get_header_image(doc, gateway_controller) -> str:
-    header_url_image = ""
-    header_image = frappe.db.get_value(
-        "Stripe Settings", gateway_controller, "header_img"
-    )
-
-    if header_image:
-        parsed_url = urllib.parse.urlparse(header_image)
-        encoded_path = urllib.parse.quote(parsed_url.path)
-        header_url_image = f"{parsed_url.scheme}://{parsed_url.netloc}{encoded_path}"
-
-    return header_url_image
+    return get_checkout_settings(gateway_controller).header_image
 
 
 @frappe.whitelist(allow_guest=True)
@@ -134,6 +158,77 @@ def make_payment(
     return data
 
 
+@frappe.whitelist()
+def charge_saved_card(payment_request, paygate_card):
+    """
+    Cobra una solicitud de pago con una tarjeta guardada por el usuario actual, en una
+    sola llamada y sin tokenizar la tarjeta de nuevo en el navegador.
+    """
+    pr = frappe.get_doc("Payment Request", payment_request)
+    card = frappe.db.get_value(
+        "PayGate Card",
+        paygate_card,
+        [
+            "name",
+            "customer",
+            "email",
+            "gateway",
+            "gateway_setting_name",
+            "stripe_customer_id",
+            "stripe_payment_id",
+        ],
+        as_dict=True,
+    )
+
+    # La tarjeta debe ser del usuario actual y del cliente de la solicitud
+    if (
+        not card
+        or card.gateway != "Stripe"
+        or card.email != frappe.session.user
+        or card.customer != pr.party
+    ):
+        frappe.throw(_("Not permitted"), frappe.PermissionError)
+
+    # Se bloquea la solicitud hasta el commit: un segundo envio espera a este y ve su
+    # estado final, en lugar de cobrar la tarjeta otra vez
+    status = frappe.db.get_value("Payment Request", pr.name, "status", for_update=True)
+    if pr.docstatus != 1 or status == "Paid":
+        frappe.throw(_("Payment Request {0} can not be paid").format(pr.name))
+
+    # La solicitud debe cobrarse con Stripe y con la configuracion de la tarjeta
+    gateway_settings = get_payment_gateway_settings(pr.payment_gateway)
+    gateway_controller = get_gateway_controller(pr.doctype, pr.name)
+    if (
+        not gateway_settings
+        or gateway_settings[0] != "Stripe Settings"
+        or card.gateway_setting_name != gateway_controller
+    ):
+        frappe.throw(
+            _("This card can not be used with the payment gateway of {0}").format(
+                pr.name
+            )
+        )
+
+    data = {
+        "amount": pr.grand_total,
+        "currency": pr.currency,
+        "title": pr.subject,
+        "description": pr.subject,
+        "reference_doctype": pr.doctype,
+        "reference_docname": pr.name,
+        "payer_name": pr.party,
+        "payer_email": pr.email_to,
+        "order_id": pr.name,
+    }
+
+    data = frappe.get_doc(
+        "Stripe Settings", gateway_controller
+    ).create_request_with_saved_card(data, card)
+
+    frappe.db.commit()
+    return data
+
+
 def is_a_subscription(reference_doctype, reference_docname):
     if not frappe.get_meta(reference_doctype).has_field("is_a_subscription"):
         return False
@@ -142,7 +237,7 @@ def is_a_subscription(reference_doctype, reference_docname):
     )
 
 
-def verify_payment(reference_doctype, reference_docname):
+def verify_payment(reference_doctype, reference_docname, payment_request_data=None):
     """
     Verifica si el pago ya fue completado, si lo fue se redirecciona a la url donde esta
     el voucher de pago.
@@ -150,26 +245,31 @@ def verify_payment(reference_doctype, reference_docname):
     Args:
     reference_doctype: Payment Request dt
     reference_docname: Nombre de la solicitud de pago
+    payment_request_data: Datos ya cargados de la solicitud (ver `get_checkout_context`)
 
     Returns:
     Dict: {"redirect_to": url, "status": "Completed"} o {}
     """
     try:
-        payment_request_data = frappe.db.get_value(
-            reference_doctype,
-            filters={"name": reference_docname},
-            fieldname=["name", "status", "pay_gate_visanet_token_ok_payment"],
-            as_dict=True,
-        )
+        if payment_request_data is None:
+            payment_request_data = frappe.db.get_value(
+                reference_doctype,
+                filters={"name": reference_docname},
+                fieldname=["name", "status", "pay_gate_visanet_token_ok_payment"],
+                as_dict=True,
+            )
 
-        frappe.log_error(
-            title="Verificando link de pago",
-            message=f"url: {payment_request_data.pay_gate_visanet_token_ok_payment} - status: {payment_request_data.status}",
+        logger.info(
+            "payment_link_verified",
+            reference_docname=reference_docname,
+            status=payment_request_data.status,
+            url=payment_request_data.pay_gate_visanet_token_ok_payment,
         )
 
         if (
             payment_request_data.status == "Paid"
-            and payment_request_data.pay_gate_visanet_token_ok_payment != ""
+            # la URL del recibo se guarda en segundo plano y puede no estar aun
+            and payment_request_data.pay_gate_visanet_token_ok_payment
         ):
             return {
                 "redirect_to": payment_request_data.pay_gate_visanet_token_ok_payment,
@@ -179,8 +279,9 @@ def verify_payment(reference_doctype, reference_docname):
         return {}
 
     except Exception:
-        frappe.log_error(
+        logger.error(
+            "payment_link_verification_failed",
             title=f"Error verificar pago {reference_docname}",
-            message=frappe.get_traceback(),
+            reference_docname=reference_docname,
         )
         return {}
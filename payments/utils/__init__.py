@@ -1,8 +1,14 @@
 from payments.utils.utils import (
 	before_install,
+	clear_payment_gateway_cache,
 	create_payment_gateway,
+	create_request_logs,
 	delete_custom_fields,
 	get_payment_gateway_controller,
+	get_payment_gateway_settings,
+	get_reference_gateway_controller,
+	get_settings_cache,
+	get_settings_snapshot,
 	make_custom_fields,
 	erpnext_app_import_guard,
 )
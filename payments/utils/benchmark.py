@@ -0,0 +1,125 @@
+"""
+Micro-benchmarks for hot payment paths, meant to be run on a real site:
+
+	bench --site <site> execute payments.utils.benchmark.benchmark_stripe_checkout \
+		--kwargs "{'payment_request': 'ACC-PRQ-2024-00001', 'baseline': 'v1.2.0'}"
+
+Each benchmark reports the number of queries and the p50/p95 latency (in ms) of the
+code path as it was at `baseline` (any git ref of the payments app from before the
+change, loaded from the app's repository) and as it is now.
+"""
+
+import os
+import subprocess
+import time
+import types
+from contextlib import contextmanager
+
+import click
+import frappe
+from frappe.utils import cint
+
+
+@contextmanager
+def count_queries():
+	"""Count the queries run through `frappe.db.sql` inside the block"""
+	counter = {"queries": 0}
+	sql = frappe.db.sql
+
+	def counting_sql(*args, **kwargs):
+		counter["queries"] += 1
+		return sql(*args, **kwargs)
+
+	frappe.db.sql = counting_sql
+	try:
+		yield counter
+	finally:
+		frappe.db.sql = sql
+
+
+def load_baseline_module(baseline, path):
+	"""Load a module of the payments app as it was at the git ref `baseline`.
+
+	`path` is relative to the app's repository, e.g. `payments/utils/utils.py`. The module
+	is not registered in `sys.modules`, so the current code is left untouched.
+	"""
+	repository = os.path.dirname(frappe.get_app_path("payments"))
+	source = subprocess.check_output(
+		["git", "-C", repository, "show", f"{baseline}:{path}"], text=True
+	)
+
+	module = types.ModuleType(f"baseline.{path.removesuffix('.py').replace('/', '.')}")
+	module.__file__ = path
+	exec(compile(source, f"{baseline}:{path}", "exec"), module.__dict__)
+	return module
+
+
+def measure(fn, iterations=200):
+	"""Run `fn` repeatedly, each time as if in a new request, and return its statistics"""
+	timings = []
+	queries = 0
+
+	for _ in range(cint(iterations)):
+		# values memoised for the request, a new request starts without them
+		frappe.local.cache = {}
+
+		with count_queries() as counter:
+			start = time.perf_counter()
+			try:
+				fn()
+			except frappe.Redirect:
+				pass
+			timings.append((time.perf_counter() - start) * 1000)
+
+		queries += counter["queries"]
+
+	timings.sort()
+	return frappe._dict(
+		queries=queries / len(timings),
+		p50=timings[len(timings) // 2],
+		p95=timings[int(len(timings) * 0.95) - 1],
+	)
+
+
+def benchmark_stripe_checkout(payment_request, baseline, iterations=200):
+	"""Compare the Stripe checkout page's context loader at `baseline` with the current one"""
+	from payments.templates.pages import stripe_checkout
+
+	baseline_checkout = load_baseline_module(
+		baseline, "payments/templates/pages/stripe_checkout.py"
+	)
+	# the page resolved its gateway controller through the settings module of its time
+	baseline_checkout.get_gateway_controller = load_baseline_module(
+		baseline, "payments/payment_gateways/doctype/stripe_settings/stripe_settings.py"
+	).get_gateway_controller
+
+	doc = frappe.get_doc("Payment Request", payment_request)
+	form_dict = frappe._dict(
+		amount=doc.grand_total,
+		title=doc.subject,
+		description=doc.subject,
+		reference_doctype=doc.doctype,
+		reference_docname=doc.name,
+		payer_name=doc.party,
+		payer_email=doc.email_to,
+		order_id=doc.name,
+		currency=doc.currency,
+	)
+
+	def run(module):
+		frappe.local.form_dict = frappe._dict(form_dict)
+		module.get_context(frappe._dict())
+
+	results = {
+		"before": measure(lambda: run(baseline_checkout), iterations),
+		"after": measure(lambda: run(stripe_checkout), iterations),
+	}
+	frappe.db.rollback()
+
+	for label, result in results.items():
+		click.echo(
+			f"{label:>6}: {result.queries:.1f} queries, "
+			f"p50 {result.p50:.2f} ms, p95 {result.p95:.2f} ms"
+		)
+
+	return results
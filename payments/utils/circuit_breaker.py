@@ -0,0 +1,261 @@
+"""
+Circuit breaker and health scoring per payment gateway account.
+
+Calls to a gateway's API are wrapped in the breaker of the settings document (merchant
+account) they are made with:
+
+	with circuit_breaker("PayPal", "PayPal Settings"):
+		response = make_post_request(url, data=params, gateway="PayPal")
+
+Outcomes and latencies are counted in rolling time buckets in Redis, shared by every
+worker of the site. Only connection errors, timeouts and 5xx responses count as failed
+calls; other errors (declined cards, invalid requests) mean the gateway answered. When
+too many calls in the window fail or are slow, the circuit opens and calls fail fast
+with `GatewayUnavailable` instead of waiting for the gateway. After `open_for` seconds a
+single call is let through to probe it; the circuit closes again if that call succeeds.
+Thresholds can be set per gateway in site config:
+
+	"payment_gateway_circuit_breaker": {
+		"default": {"window": 60, "min_calls": 10, "error_rate": 0.5, "open_for": 30},
+		"Mpesa": {"slow_call": 15}
+	}
+"""
+
+import hashlib
+import time
+from contextlib import contextmanager
+
+import frappe
+import requests
+from frappe import _
+from frappe.utils import cint, flt
+
+from payments.utils.logger import get_logger
+from payments.utils.utils import get_payments_config
+
+DEFAULT_CIRCUIT_BREAKER_CONFIG = {
+	# rolling window in seconds, split in `buckets` buckets
+	"window": 60,
+	"buckets": 6,
+	# calls needed in the window before the error and slow rates are considered
+	"min_calls": 10,
+	"error_rate": 0.5,
+	# calls taking longer than `slow_call` seconds count as slow
+	"slow_call": 10,
+	"slow_rate": 0.5,
+	"open_for": 30,
+}
+
+# an open circuit is forgotten after a day without calls
+STATE_EXPIRY = 86400
+
+
+class GatewayUnavailable(frappe.ValidationError):
+	http_status_code = 503
+
+
+def get_circuit_breaker_config(gateway):
+	return get_payments_config(
+		"payment_gateway_circuit_breaker", DEFAULT_CIRCUIT_BREAKER_CONFIG, "default", gateway
+	)
+
+
+class CircuitBreaker:
+	"""Circuit breaker of one gateway account"""
+
+	def __init__(self, gateway, account=None, config=None, redis=None):
+		config = config or get_circuit_breaker_config(gateway)
+
+		self.gateway = gateway
+		self.buckets = max(cint(config.buckets), 1)
+		self.bucket_size = max(cint(config.window) // self.buckets, 1)
+		self.min_calls = cint(config.min_calls)
+		self.error_rate = flt(config.error_rate)
+		self.slow_call = flt(config.slow_call)
+		self.slow_rate = flt(config.slow_rate)
+		self.open_for = max(cint(config.open_for), 1)
+		self.redis = redis or frappe.cache()
+		self.key = self.redis.make_key(get_breaker_key(gateway, account))
+		self.logger = get_logger(gateway)
+
+	@contextmanager
+	def guard(self, failures=()):
+		"""Run the block as a call to the gateway, or raise `GatewayUnavailable` if the
+		circuit is open.
+
+		`failures` are the exception types of the gateway's SDK that also mean it is down.
+		"""
+		if not self.allow_request():
+			raise GatewayUnavailable(
+				_("{0} is not responding at the moment, please try again in a few minutes").format(
+					self.gateway
+				)
+			)
+
+		started = time.monotonic()
+		try:
+			yield
+		except Exception as e:
+			self.record(not is_gateway_failure(e, failures), time.monotonic() - started)
+			raise
+
+		self.record(True, time.monotonic() - started)
+
+	def get_state(self):
+		"""Return "closed", "open" or "half-open" (open, but due for a probe)"""
+		state, opened = (
+			self.redis.pipeline().get(f"{self.key}|state").exists(f"{self.key}|opened").execute()
+		)
+		if not state:
+			return "closed"
+
+		return "open" if opened else "half-open"
+
+	def allow_request(self):
+		try:
+			state = self.get_state()
+			if state == "half-open":
+				# only one call probes the gateway, the others keep failing fast
+				return bool(
+					self.redis.pipeline()
+					.set(f"{self.key}|probe", 1, nx=True, ex=self.open_for)
+					.execute()[0]
+				)
+
+			return state == "closed"
+		except Exception:
+			# never block payments on the breaker itself
+			return True
+
+	def record(self, success, elapsed):
+		"""Count the outcome of a call and open or close the circuit accordingly"""
+		slow = elapsed >= self.slow_call
+		bucket = f"{self.key}|{self.get_bucket_index()}"
+
+		try:
+			pipeline = self.redis.pipeline()
+			pipeline.hincrby(bucket, "calls", 1)
+			pipeline.hincrby(bucket, "failures", 0 if success else 1)
+			pipeline.hincrby(bucket, "slow", 1 if slow else 0)
+			pipeline.hincrbyfloat(bucket, "latency", elapsed)
+			pipeline.expire(bucket, self.bucket_size * (self.buckets + 1))
+			pipeline.execute()
+
+			state = self.get_state()
+			if state == "half-open":
+				# outcome of the probe
+				if success and not slow:
+					self.close()
+				else:
+					self.open()
+
+			elif state == "closed" and (slow or not success):
+				stats = self.get_window_stats()
+				if stats.calls >= self.min_calls and (
+					stats.error_rate >= self.error_rate or stats.slow_rate >= self.slow_rate
+				):
+					self.open(stats)
+		except Exception:
+			pass
+
+	def open(self, stats=None):
+		(
+			self.redis.pipeline()
+			.set(f"{self.key}|state", "open", ex=STATE_EXPIRY)
+			.set(f"{self.key}|opened", 1, ex=self.open_for)
+			.delete(f"{self.key}|probe")
+			.execute()
+		)
+		self.logger.warning("circuit_opened", open_for=self.open_for, **(stats or {}))
+
+	def close(self):
+		current = self.get_bucket_index()
+		# forget the failures that opened the circuit
+		buckets = [f"{self.key}|{index}" for index in range(current - self.buckets, current + 1)]
+		self.redis.pipeline().delete(
+			f"{self.key}|state", f"{self.key}|opened", f"{self.key}|probe", *buckets
+		).execute()
+		self.logger.info("circuit_closed")
+
+	def get_bucket_index(self):
+		return int(time.time() // self.bucket_size)
+
+	def get_window_stats(self):
+		current = self.get_bucket_index()
+		pipeline = self.redis.pipeline()
+		for index in range(current - self.buckets + 1, current + 1):
+			pipeline.hgetall(f"{self.key}|{index}")
+
+		stats = frappe._dict(calls=0, failures=0, slow=0, latency=0.0)
+		for bucket in pipeline.execute():
+			for field, value in bucket.items():
+				stats[frappe.safe_decode(field)] += flt(value)
+
+		calls = stats.calls or 1
+		stats.error_rate = round(stats.failures / calls, 3)
+		stats.slow_rate = round(stats.slow / calls, 3)
+		stats.average_latency = round(stats.pop("latency") / calls, 3)
+		return stats
+
+	def get_health(self):
+		"""Return the state of the circuit, the window's statistics and a health score
+		between 0 (unavailable) and 1"""
+		state = self.get_state()
+		stats = self.get_window_stats()
+
+		score = 0
+		if state != "open":
+			score = round(1 - max(stats.error_rate, stats.slow_rate), 3)
+
+		return frappe._dict(gateway=self.gateway, state=state, score=score, **stats)
+
+
+def get_breaker_key(gateway, account=None):
+	account_hash = hashlib.sha256((account or "").encode()).hexdigest()[:16]
+	return f"payments|circuit_breaker|{gateway}|{account_hash}"
+
+
+def is_gateway_failure(exception, failures=()):
+	"""Return True if the exception means the gateway could not be reached or failed to
+	answer: connection errors, timeouts, 5xx responses and the given `failures`"""
+	if isinstance(
+		exception,
+		(requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError, *failures),
+	):
+		return True
+
+	response = getattr(exception, "response", None)
+	return cint(getattr(response, "status_code", None)) >= 500
+
+
+def get_circuit_breaker(gateway, account=None):
+	breakers = getattr(frappe.local, "payments_circuit_breakers", None)
+	if breakers is None:
+		breakers = frappe.local.payments_circuit_breakers = {}
+
+	if (gateway, account) not in breakers:
+		breakers[(gateway, account)] = CircuitBreaker(gateway, account)
+
+	return breakers[(gateway, account)]
+
+
+def circuit_breaker(gateway, account=None, failures=()):
+	"""Context manager running a call to the gateway through the circuit breaker of the
+	account"""
+	return get_circuit_breaker(gateway, account).guard(failures)
+
+
+def is_gateway_available(gateway, account=None):
+	"""Return False while the circuit of the gateway account is open"""
+	try:
+		return get_circuit_breaker(gateway, account).get_state() != "open"
+	except Exception:
+		return True
+
+
+@frappe.whitelist()
+def get_gateway_health(gateway, account=None):
+	"""Return the circuit state and health statistics of a gateway account, e.g. `Mpesa`
+	and the name of its Mpesa Settings"""
+	frappe.only_for("System Manager")
+	return get_circuit_breaker(gateway, account).get_health()
@@ -0,0 +1,98 @@
+"""
+Storage codec for gateway payloads (Integration Request `data`/`output`/`error` and
+response logs).
+
+Payloads are stored as compact JSON. When enabled in site config, payloads larger than
+the threshold are stored zlib-compressed and base64-encoded behind a version marker:
+
+	"payments_payload_codec": {"compress": 1, "threshold": 1024, "level": 6}
+
+Only Integration Requests of this app's gateways (`PAYMENTS_SERVICES`) are compressed,
+other apps read theirs as plain JSON. `decode_payload` reads every format, including the
+pretty-printed JSON of older rows and plain-text values.
+"""
+
+import base64
+import json
+import zlib
+
+import frappe
+from frappe.utils import cint
+
+from payments.utils.utils import get_payments_config
+
+COMPRESSED_MARKER = "pz1:"
+DEFAULT_CODEC_CONFIG = {"compress": 0, "threshold": 1024, "level": 6}
+MEMO_SIZE = 1000
+
+# `integration_request_service` of the gateways in this app
+PAYMENTS_SERVICES = frozenset(
+	["Braintree", "GoCardless", "Mpesa", "PayPal", "Paytm", "Razorpay", "Stripe"]
+)
+
+
+def get_codec_config():
+	return get_payments_config("payments_payload_codec", DEFAULT_CODEC_CONFIG)
+
+
+def encode_payload(payload, compress=True):
+	"""Return `payload` (a JSON string or a JSON-serialisable object) in its storage format.
+
+	With `compress=False` the payload is always stored as plain JSON.
+	"""
+	if payload is None:
+		return None
+
+	if isinstance(payload, str):
+		if payload.startswith(COMPRESSED_MARKER):
+			return payload
+		try:
+			payload = json.loads(payload)
+		except ValueError:
+			# not JSON, e.g. an error message; stored as is
+			return payload
+
+	text = frappe.as_json(payload, indent=None, separators=(",", ":"))
+
+	config = get_codec_config()
+	if not compress or not cint(config.compress) or len(text) < cint(config.threshold):
+		return text
+
+	compressed = zlib.compress(text.encode(), cint(config.level))
+	return COMPRESSED_MARKER + base64.b64encode(compressed).decode()
+
+
+def decode_payload(value):
+	"""Parse a stored payload, memoised for the current request or job.
+
+	Dicts and lists are returned as shallow copies of the memoised value, so callers can
+	update them at the top level without affecting other readers.
+	"""
+	if not value:
+		return frappe._dict()
+
+	if not isinstance(value, str):
+		return value
+
+	cache = getattr(frappe.local, "payments_payload_cache", None)
+	if cache is None or len(cache) >= MEMO_SIZE:
+		# bounded, jobs like the capture loop decode thousands of payloads
+		cache = frappe.local.payments_payload_cache = {}
+
+	if value not in cache:
+		if value.startswith(COMPRESSED_MARKER):
+			text = zlib.decompress(base64.b64decode(value[len(COMPRESSED_MARKER) :])).decode()
+			cache[value] = json.loads(text)
+		else:
+			try:
+				cache[value] = json.loads(value)
+			except ValueError:
+				# not JSON, e.g. an error message stored as is by `encode_payload`
+				cache[value] = value
+
+	payload = cache[value]
+	if isinstance(payload, dict):
+		return frappe._dict(payload)
+	if isinstance(payload, list):
+		return list(payload)
+	return payload
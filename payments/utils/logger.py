@@ -0,0 +1,119 @@
+"""
+Leveled, sampled diagnostic logging for payment gateways.
+
+	logger = get_logger("Stripe")
+	logger.info("payment_link_verified", reference_docname=name, status=status)
+
+Traces are written off the request path to the rotating `payments` log of the site
+(see `frappe.logger`), through a queue drained by a background thread. `error` also
+creates an Error Log, as `frappe.log_error` did. Levels and per-event sampling rates
+can be set per gateway in site config:
+
+	"payments_logging": {
+		"default": {"level": "INFO"},
+		"Stripe": {"level": "DEBUG", "sample_rates": {"payment_link_verified": 0.1}}
+	}
+"""
+
+import atexit
+import json
+import logging
+import random
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+import frappe
+
+from payments.utils.utils import get_payments_config
+
+DEFAULT_LOGGING_CONFIG = {"level": "INFO", "sample_rates": {}}
+
+_sinks = {}
+_sinks_lock = threading.Lock()
+
+
+class PaymentsLogger:
+	def __init__(self, gateway):
+		self.gateway = gateway
+
+	def debug(self, event, **fields):
+		self.log(logging.DEBUG, event, fields)
+
+	def info(self, event, **fields):
+		self.log(logging.INFO, event, fields)
+
+	def warning(self, event, **fields):
+		self.log(logging.WARNING, event, fields)
+
+	def error(self, event, title=None, **fields):
+		"""Log an error event and record it in Error Log, with the current traceback if any"""
+		self.log(logging.ERROR, event, fields, sampled=False)
+		frappe.log_error(
+			title=title or f"{self.gateway}: {event}", message=get_error_message(fields)
+		)
+
+	def is_enabled_for(self, level, event=None):
+		config = get_logging_config(self.gateway)
+		if level < get_level(config.level):
+			return False
+
+		sample_rate = (config.sample_rates or {}).get(event, 1)
+		return sample_rate >= 1 or random.random() < sample_rate
+
+	def log(self, level, event, fields, sampled=True):
+		if sampled and not self.is_enabled_for(level, event):
+			return
+
+		message = {"gateway": self.gateway, "event": event, **fields}
+		get_sink().log(level, json.dumps(message, default=str))
+
+
+def get_logger(gateway):
+	"""Return the diagnostic logger of a gateway"""
+	return PaymentsLogger(gateway)
+
+
+def get_logging_config(gateway):
+	return get_payments_config("payments_logging", DEFAULT_LOGGING_CONFIG, "default", gateway)
+
+
+def get_level(name):
+	level = logging.getLevelName(str(name).upper())
+	return level if isinstance(level, int) else logging.INFO
+
+
+def get_error_message(fields):
+	traceback = frappe.get_traceback()
+	if traceback and traceback.strip() != "NoneType: None":
+		fields = dict(fields, traceback=traceback)
+
+	return json.dumps(fields, default=str, indent=1)
+
+
+def get_sink():
+	"""Return a logger that hands records to the site's `payments` log through a queue.
+
+	The file handlers of `frappe.logger` only run on the listener thread, so the request
+	only pays for putting the record on the queue.
+	"""
+	target = frappe.logger("payments", allow_site=True)
+
+	sink = _sinks.get(target.name)
+	if sink:
+		return sink
+
+	with _sinks_lock:
+		if target.name not in _sinks:
+			queue = SimpleQueue()
+			listener = QueueListener(queue, *target.handlers, respect_handler_level=True)
+			listener.start()
+			atexit.register(listener.stop)
+
+			sink = logging.getLogger(f"{target.name}-queued")
+			sink.setLevel(logging.DEBUG)
+			sink.propagate = False
+			sink.addHandler(QueueHandler(queue))
+			_sinks[target.name] = sink
+
+	return _sinks[target.name]
@@ -0,0 +1,148 @@
+"""
+Client-side rate limiting for calls to payment gateway APIs.
+
+Calls are throttled with a token bucket per gateway and credential, kept in Redis, so
+every worker on the bench draws from the same quota. Rates (tokens per second), burst
+sizes and the longest time a call may wait for a token can be set per gateway in site
+config:
+
+	"payment_gateway_rate_limits": {
+		"default": {"rate": 10, "burst": 20, "timeout": 10},
+		"Stripe": {"rate": 80, "burst": 100}
+	}
+
+Credentials are hashed before they become part of a bucket key.
+"""
+
+import hashlib
+import time
+
+import frappe
+
+from payments.utils.utils import get_payments_config
+
+DEFAULT_RATE_LIMITS = {
+	"default": {"rate": 10, "burst": 20, "timeout": 10},
+	# Stripe allows 100 read and write operations per second in live mode
+	"Stripe": {"rate": 80, "burst": 100},
+}
+
+# Takes `requested` tokens if the bucket has them and returns "0", otherwise returns the
+# seconds to wait until it will. Uses the Redis clock, so all workers agree on time.
+TOKEN_BUCKET_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local requested = tonumber(ARGV[3])
+
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens >= requested then
+	tokens = tokens - requested
+else
+	wait = (requested - tokens) / rate
+end
+
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 60)
+return tostring(wait)
+"""
+
+
+# Empties the bucket as of now, so refilling starts from zero
+DRAIN_SCRIPT = """
+if redis.replicate_commands then redis.replicate_commands() end
+
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+
+redis.call("HSET", KEYS[1], "tokens", 0, "updated", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(tonumber(ARGV[1]) / tonumber(ARGV[2])) + 60)
+return 1
+"""
+
+
+class GatewayRateLimitExceeded(frappe.RateLimitExceededError):
+	pass
+
+
+def get_rate_limit_config(gateway):
+	defaults = {**DEFAULT_RATE_LIMITS["default"], **DEFAULT_RATE_LIMITS.get(gateway, {})}
+	return get_payments_config("payment_gateway_rate_limits", defaults, "default", gateway)
+
+
+class TokenBucket:
+	"""Token bucket of one gateway credential"""
+
+	def __init__(self, gateway, credential=None, config=None, redis=None):
+		config = config or get_rate_limit_config(gateway)
+
+		self.gateway = gateway
+		self.rate = float(config.rate)
+		self.burst = float(config.burst)
+		self.timeout = float(config.timeout)
+		self.key = get_bucket_key(gateway, credential)
+		self.redis = redis or frappe.cache()
+		self.script = self.redis.register_script(TOKEN_BUCKET_SCRIPT)
+		self.drain_script = self.redis.register_script(DRAIN_SCRIPT)
+
+	def acquire(self, tokens=1, timeout=None):
+		"""Wait until `tokens` are available and take them.
+
+		Raises `GatewayRateLimitExceeded` if they would not be available within `timeout`
+		seconds (the configured timeout by default).
+		"""
+		deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+
+		while True:
+			try:
+				wait = float(self.script(keys=[self.key], args=[self.rate, self.burst, tokens]))
+			except Exception:
+				# never block payments on the limiter itself
+				return
+
+			if not wait:
+				return
+
+			if time.monotonic() + wait > deadline:
+				raise GatewayRateLimitExceeded(
+					f"{self.gateway} rate limit: no capacity within {self.timeout} seconds"
+				)
+
+			time.sleep(wait)
+
+	def drain(self):
+		"""Empty the bucket, after the gateway answered `429 Too Many Requests`"""
+		try:
+			self.drain_script(keys=[self.key], args=[self.burst, self.rate])
+		except Exception:
+			pass
+
+
+def get_bucket_key(gateway, credential=None):
+	credential_hash = hashlib.sha256((credential or "").encode()).hexdigest()[:16]
+	return f"payments|rate_limit|{gateway}|{credential_hash}"
+
+
+def acquire(gateway, credential=None, tokens=1, timeout=None):
+	"""Take `tokens` from the bucket of a gateway credential, waiting if needed"""
+	get_token_bucket(gateway, credential).acquire(tokens, timeout)
+
+
+def get_token_bucket(gateway, credential=None):
+	buckets = getattr(frappe.local, "payments_token_buckets", None)
+	if buckets is None:
+		buckets = frappe.local.payments_token_buckets = {}
+
+	if (gateway, credential) not in buckets:
+		buckets[(gateway, credential)] = TokenBucket(gateway, credential)
+
+	return buckets[(gateway, credential)]
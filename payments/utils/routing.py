@@ -0,0 +1,192 @@
+"""
+Routing of payments to the best eligible payment gateway.
+
+Routing is opt-in. The Payment Gateways to choose from are listed in site config:
+
+	"payments_gateway_routing": {"gateways": ["Stripe-Main", "PayPal", "Braintree-Main"]}
+
+`get_checkout_url` and web forms accepting payments then send each payment to the
+healthiest and fastest of these gateways that supports its currency and amount, and
+fall back to the gateway they were configured with when none does.
+
+Decisions are made in memory: the capability index (currencies, minimum amounts and
+transaction limits per gateway) is built once per worker and rebuilt when a gateway or
+its settings change, and the health and latency of each gateway (see
+`payments.utils.circuit_breaker`) are refreshed every few seconds.
+"""
+
+import time
+
+import frappe
+from frappe.model.base_document import get_controller
+from frappe.utils import cint, flt
+
+from payments.utils.circuit_breaker import get_circuit_breaker
+from payments.utils.utils import get_payment_gateway_settings, get_settings_cache
+
+HEALTH_REFRESH_INTERVAL = 5
+
+# gateways without calls in the window, or not called through a circuit breaker: ranked
+# after healthy measured gateways, and after any measured gateway of the same score
+UNKNOWN_HEALTH = frappe._dict(state="closed", score=0.5, average_latency=float("inf"))
+
+# per-process health snapshot of each site: `(refresh after, {(gateway, account): health})`
+_health = {}
+
+
+def get_routing_config():
+	return frappe._dict(frappe.conf.get("payments_gateway_routing") or {})
+
+
+def is_routing_enabled():
+	return bool(get_routing_config().gateways)
+
+
+def route_payment_gateway(
+	amount, currency, default=None, reference_doctype=None, reference_docname=None
+):
+	"""Return the Payment Gateway to take a payment of `amount` in `currency` with, or
+	`default` if none of the routed gateways can.
+
+	References with their own gateway, like Payment Requests, are only routed to gateways
+	with a Payment Gateway Account in the currency, which is then saved on the reference:
+	checkout pages load their settings, and the accounting its account, from there.
+	"""
+	eligible = get_eligible_gateways(amount, currency)
+	if not (reference_doctype and reference_docname):
+		return eligible[0].payment_gateway if eligible else default
+
+	if not frappe.get_meta(reference_doctype).has_field("payment_gateway_account"):
+		return eligible[0].payment_gateway if eligible else default
+
+	current = frappe.db.get_value(reference_doctype, reference_docname, "payment_gateway")
+	for capability in eligible:
+		if capability.payment_gateway == current:
+			return current
+
+		if set_reference_gateway(
+			reference_doctype, reference_docname, capability.payment_gateway, currency
+		):
+			return capability.payment_gateway
+
+	return default
+
+
+def set_reference_gateway(reference_doctype, reference_docname, payment_gateway, currency):
+	"""Switch the reference to the Payment Gateway Account of `payment_gateway` in
+	`currency`, return False if there is none"""
+	account = frappe.db.get_value(
+		"Payment Gateway Account",
+		{"payment_gateway": payment_gateway, "currency": currency},
+		["name", "payment_account"],
+		as_dict=True,
+	)
+	if not account:
+		return False
+
+	meta = frappe.get_meta(reference_doctype)
+	values = {"payment_gateway_account": account.name, "payment_gateway": payment_gateway}
+	if meta.has_field("payment_account"):
+		values["payment_account"] = account.payment_account
+
+	frappe.db.set_value(reference_doctype, reference_docname, values)
+	return True
+
+
+def get_eligible_gateways(amount, currency):
+	"""Return the capabilities of the routed gateways supporting the amount and currency,
+	best first"""
+	amount = flt(amount)
+	currency = (currency or "").upper()
+	routed = get_routing_config().gateways or []
+	index = get_capability_index()
+	health = get_health_snapshot(
+		{(index[name].gateway, index[name].account) for name in routed if name in index}
+	)
+
+	ranked = []
+	for position, name in enumerate(routed):
+		capability = index.get(name)
+		if (
+			not capability
+			or currency not in capability.currencies
+			or amount < capability.minimum_amounts.get(currency, 0)
+		):
+			continue
+
+		gateway_health = health.get((capability.gateway, capability.account)) or UNKNOWN_HEALTH
+		if gateway_health.state == "open":
+			continue
+
+		# amounts above the transaction limit take several transactions, e.g. M-Pesa
+		over_limit = bool(capability.transaction_limit and amount > capability.transaction_limit)
+		ranked.append(
+			(
+				# small differences in health don't outweigh latency
+				-round(gateway_health.score, 1),
+				over_limit,
+				gateway_health.average_latency,
+				position,
+				capability,
+			)
+		)
+
+	return [row[-1] for row in sorted(ranked, key=lambda row: row[:-1])]
+
+
+def get_capability_index():
+	"""Return the capabilities of every Payment Gateway, by name"""
+	return get_settings_cache("Payment Gateway", None, "capability_index", build_capability_index)
+
+
+def build_capability_index():
+	index = {}
+	for payment_gateway in frappe.get_all("Payment Gateway", pluck="name"):
+		settings = get_payment_gateway_settings(payment_gateway)
+		if not settings:
+			continue
+
+		doctype, name = settings
+		controller = get_controller(doctype)
+
+		transaction_limit = 0
+		if frappe.get_meta(doctype).has_field("transaction_limit"):
+			transaction_limit = flt(frappe.db.get_value(doctype, name, "transaction_limit"))
+
+		index[payment_gateway] = frappe._dict(
+			payment_gateway=payment_gateway,
+			# gateway and account of the circuit breaker
+			gateway=doctype.removesuffix(" Settings"),
+			account=name,
+			currencies=frozenset(getattr(controller, "supported_currencies", None) or []),
+			minimum_amounts=dict(
+				getattr(controller, "currency_wise_minimum_charge_amount", None) or {}
+			),
+			transaction_limit=transaction_limit,
+		)
+
+	return index
+
+
+def get_health_snapshot(accounts):
+	"""Return the health of the `(gateway, account)` circuits, refreshed at most every few
+	seconds per worker"""
+	refresh_after, health = _health.get(frappe.local.site, (0, {}))
+	if time.monotonic() < refresh_after and accounts <= health.keys():
+		return health
+
+	health = {}
+	for gateway, account in accounts:
+		try:
+			gateway_health = get_circuit_breaker(gateway, account).get_health()
+			if gateway_health.state != "closed" or gateway_health.calls:
+				health[(gateway, account)] = gateway_health
+			else:
+				health[(gateway, account)] = UNKNOWN_HEALTH
+		except Exception:
+			# don't keep the gateway out of routing because its health is unknown
+			health[(gateway, account)] = UNKNOWN_HEALTH
+
+	interval = cint(get_routing_config().health_refresh_interval) or HEALTH_REFRESH_INTERVAL
+	_health[frappe.local.site] = (time.monotonic() + interval, health)
+	return health
@@ -0,0 +1,63 @@
+"""
+Cache of decrypted gateway secrets (Password fields of settings documents).
+
+	api_secret = get_cached_password("Razorpay Settings", "Razorpay Settings", "api_secret")
+
+Each worker keeps a decrypted secret for a short time and drops it as soon as its
+settings document is saved (see `get_settings_cache`), so a request or job decrypts
+each secret at most once. Optionally, secrets are also shared between workers through
+Redis, encrypted with the site's encryption key, so a cold worker skips the database:
+
+	"payments_secret_cache": {"ttl": 300, "redis": 1}
+"""
+
+import frappe
+from frappe.utils import cint
+from frappe.utils.password import decrypt, encrypt, get_decrypted_password
+
+from payments.utils.utils import get_payments_config, get_settings_cache, get_settings_version
+
+DEFAULT_SECRET_CACHE_CONFIG = {"ttl": 300, "redis": 0}
+
+
+def get_secret_cache_config():
+	return get_payments_config("payments_secret_cache", DEFAULT_SECRET_CACHE_CONFIG)
+
+
+def get_cached_password(doctype, name, fieldname):
+	"""Return the decrypted value of a Password field, `None` if it is not set"""
+	config = get_secret_cache_config()
+	return get_settings_cache(
+		doctype,
+		name,
+		f"password::{fieldname}",
+		lambda: load_password(doctype, name, fieldname, config),
+		ttl=cint(config.ttl),
+	)
+
+
+def get_doc_password(doc, fieldname):
+	"""Like `Document.get_password`, but cached for saved values"""
+	value = doc.get(fieldname)
+	if value and not doc.is_dummy_password(value):
+		# set on the document and not saved yet, e.g. while validating new credentials
+		return value
+
+	return get_cached_password(doc.doctype, doc.name, fieldname)
+
+
+def load_password(doctype, name, fieldname, config):
+	if not cint(config.redis):
+		return get_decrypted_password(doctype, name, fieldname, raise_exception=False)
+
+	# the version changes when the settings are saved, so old copies are never read
+	key = f"payments_secret|{doctype}|{name}|{fieldname}|{get_settings_version(doctype, name)}"
+	encrypted = frappe.cache().get_value(key)
+	if encrypted:
+		return decrypt(encrypted)
+
+	value = get_decrypted_password(doctype, name, fieldname, raise_exception=False)
+	if value:
+		frappe.cache().set_value(key, encrypt(value), expires_in_sec=cint(config.ttl) or None)
+
+	return value
@@ -0,0 +1,88 @@
+# Copyright (c) 2024, Frappe Technologies and Contributors
+# License: MIT. See LICENSE
+import json
+import unittest
+from unittest.mock import patch
+
+import frappe
+
+from payments.utils.codec import COMPRESSED_MARKER, decode_payload, encode_payload
+
+COMPRESS = {"payments_payload_codec": {"compress": 1, "threshold": 64, "level": 6}}
+
+
+class TestPayloadCodec(unittest.TestCase):
+	def setUp(self):
+		self.payload = {
+			"amount": 1000,
+			"currency": "usd",
+			"description": "Payment for Sales Invoice " * 10,
+			"metadata": {"reference_doctype": "Sales Invoice", "reference_docname": "SINV-0001"},
+		}
+
+	def tearDown(self):
+		frappe.db.rollback()
+
+	def test_round_trip(self):
+		stored = encode_payload(self.payload, compress=False)
+		self.assertFalse(stored.startswith(COMPRESSED_MARKER))
+		# compact JSON, without the indentation of older rows
+		self.assertNotIn("\n", stored)
+		self.assertNotIn('": ', stored)
+		self.assertEqual(decode_payload(stored), self.payload)
+
+		with patch.dict(frappe.conf, COMPRESS):
+			stored = encode_payload(json.dumps(self.payload))
+
+		self.assertTrue(stored.startswith(COMPRESSED_MARKER))
+		self.assertEqual(decode_payload(stored), self.payload)
+		# already encoded payloads are kept as they are
+		self.assertEqual(encode_payload(stored), stored)
+
+	def test_legacy_row_is_read(self):
+		# rows stored before the codec hold pretty-printed JSON
+		integration_request = insert_integration_request("Stripe", self.payload)
+		frappe.db.set_value(
+			"Integration Request",
+			integration_request.name,
+			"data",
+			json.dumps(self.payload, indent=4),
+			update_modified=False,
+		)
+
+		data = frappe.db.get_value("Integration Request", integration_request.name, "data")
+		self.assertEqual(decode_payload(data), self.payload)
+
+		integration_request.reload()
+		integration_request.handle_success({"status": "succeeded"})
+		output = frappe.db.get_value("Integration Request", integration_request.name, "output")
+		self.assertEqual(decode_payload(output), {"status": "succeeded"})
+
+	def test_compressed_row(self):
+		with patch.dict(frappe.conf, COMPRESS):
+			integration_request = insert_integration_request("Stripe", self.payload)
+
+		data = frappe.db.get_value("Integration Request", integration_request.name, "data")
+		self.assertTrue(data.startswith(COMPRESSED_MARKER))
+		self.assertEqual(decode_payload(data), self.payload)
+
+	def test_other_services_are_untouched(self):
+		data = json.dumps(self.payload, indent=4)
+		with patch.dict(frappe.conf, COMPRESS):
+			integration_request = insert_integration_request("Frappe Mail", data)
+
+		self.assertFalse(integration_request.uses_codec())
+		self.assertEqual(
+			frappe.db.get_value("Integration Request", integration_request.name, "data"), data
+		)
+
+
+def insert_integration_request(service, data):
+	return frappe.get_doc(
+		{
+			"doctype": "Integration Request",
+			"integration_request_service": service,
+			"data": data if isinstance(data, str) else json.dumps(data),
+			"status": "Queued",
+		}
+	).insert(ignore_permissions=True)
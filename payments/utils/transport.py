@@ -0,0 +1,232 @@
+"""
+Per-process HTTP transport shared by all payment gateways.
+
+Every gateway talks to its upstream through a pooled, keep-alive `requests.Session`
+(one per site, gateway and host), with connect/read timeouts and a bounded retry policy
+for idempotent requests. Each request first takes a token from the rate limiter of
+its gateway credential (see `payments.utils.rate_limiter`). Defaults can be overridden
+per gateway in site config:
+
+	"payment_gateway_http": {
+		"default": {"connect_timeout": 5, "read_timeout": 30},
+		"Mpesa": {"read_timeout": 60, "pool_maxsize": 20, "max_retries": 3}
+	}
+"""
+
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import frappe
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from payments.utils.rate_limiter import TokenBucket, get_rate_limit_config
+from payments.utils.utils import get_payments_config
+
+DEFAULT_HTTP_CONFIG = {
+	"connect_timeout": 5,
+	"read_timeout": 30,
+	"pool_connections": 4,
+	"pool_maxsize": 10,
+	"max_retries": 2,
+	"backoff_factor": 0.3,
+}
+
+RETRY_STATUS_CODES = (502, 503, 504)
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+
+# connection pools are shared by every site on the bench, sessions are per site
+_adapters = {}
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_http_config(gateway=None):
+	"""Return the transport settings for a gateway, merged over the defaults"""
+	return get_payments_config("payment_gateway_http", DEFAULT_HTTP_CONFIG, "default", gateway)
+
+
+def get_timeout(gateway=None):
+	"""Return the `(connect, read)` timeout tuple for a gateway"""
+	config = get_http_config(gateway)
+	return (config.connect_timeout, config.read_timeout)
+
+
+def get_session(gateway, url):
+	"""Return the session of the current site for the gateway and the host of `url`.
+
+	Sessions of every site share the gateway's connection pool, which lives for the
+	lifetime of the worker process, so connections (and TLS handshakes) are reused across
+	requests, jobs and sites. Rate limits are applied with the site's own settings.
+	"""
+	parts = urlsplit(url)
+	key = (frappe.local.site, gateway, parts.scheme, parts.netloc)
+
+	session = _sessions.get(key)
+	if session:
+		return session
+
+	config = get_http_config(gateway)
+	with _sessions_lock:
+		if key not in _sessions:
+			adapter = get_adapter(config, gateway, parts.scheme, parts.netloc)
+			_sessions[key] = make_session(config, gateway, adapter)
+
+	return _sessions[key]
+
+
+def get_adapter(config, gateway, scheme, netloc):
+	"""Return the pooled adapter for the gateway and host, one per distinct pool and
+	retry configuration"""
+	key = (
+		gateway,
+		scheme,
+		netloc,
+		config.pool_connections,
+		config.pool_maxsize,
+		config.max_retries,
+		config.backoff_factor,
+	)
+	if key not in _adapters:
+		_adapters[key] = make_adapter(config)
+
+	return _adapters[key]
+
+
+def make_adapter(config):
+	retry = Retry(
+		total=config.max_retries,
+		connect=config.max_retries,
+		read=config.max_retries,
+		status=config.max_retries,
+		backoff_factor=config.backoff_factor,
+		status_forcelist=RETRY_STATUS_CODES,
+		allowed_methods=IDEMPOTENT_METHODS,
+		raise_on_status=False,
+	)
+	return HTTPAdapter(
+		pool_connections=config.pool_connections,
+		pool_maxsize=config.pool_maxsize,
+		max_retries=retry,
+	)
+
+
+def make_session(config, gateway=None, adapter=None):
+	adapter = adapter or make_adapter(config)
+
+	session = RateLimitedSession(gateway, config) if gateway else requests.Session()
+	session.mount("https://", adapter)
+	session.mount("http://", adapter)
+	return session
+
+
+class RateLimitedSession(requests.Session):
+	"""Session that takes a token from the gateway credential's bucket before every request.
+
+	When the gateway still answers `429 Too Many Requests`, the bucket is drained and the
+	request is sent again after `Retry-After`, up to `max_retries` times; the last 429
+	response is returned to the caller.
+	"""
+
+	def __init__(self, gateway, config):
+		super().__init__()
+		self.gateway = gateway
+		self.max_rate_limited_retries = config.max_retries
+		# resolved here for the session's site, requests may be sent from worker threads
+		self.rate_limit_config = get_rate_limit_config(gateway)
+		self.redis = frappe.cache()
+		self.buckets = {}
+
+	def request(self, method, url, *args, **kwargs):
+		bucket = self.get_bucket(self.get_credential(kwargs))
+
+		for attempt in range(self.max_rate_limited_retries + 1):
+			bucket.acquire()
+			response = super().request(method, url, *args, **kwargs)
+			if response.status_code != 429 or attempt == self.max_rate_limited_retries:
+				return response
+
+			bucket.drain()
+			time.sleep(min(get_retry_after(response), bucket.timeout))
+
+	def get_bucket(self, credential):
+		if credential not in self.buckets:
+			self.buckets[credential] = TokenBucket(
+				self.gateway, credential, config=self.rate_limit_config, redis=self.redis
+			)
+
+		return self.buckets[credential]
+
+	def get_credential(self, kwargs):
+		"""Return what identifies the account a request is made for: the basic auth user
+		or the Authorization header"""
+		auth = kwargs.get("auth") or self.auth
+		if isinstance(auth, tuple | list) and auth:
+			return str(auth[0])
+		if getattr(auth, "username", None):
+			return auth.username
+
+		headers = kwargs.get("headers") or {}
+		return headers.get("Authorization") or self.headers.get("Authorization")
+
+
+def get_retry_after(response):
+	try:
+		return max(float(response.headers.get("Retry-After") or 1), 0)
+	except ValueError:
+		return 1
+
+
+def send_request(gateway, method, url, timeout=None, **kwargs):
+	"""Send a request through the gateway's pooled session and return the raw response"""
+	session = get_session(gateway, url)
+	return session.request(method, url, timeout=timeout or get_timeout(gateway), **kwargs)
+
+
+def make_request(
+	method, url, gateway=None, auth=None, headers=None, data=None, json=None, params=None
+):
+	"""Drop-in replacement for `frappe.integrations.utils.make_request` that goes through the
+	gateway's pooled session and timeouts."""
+	auth = auth or ""
+	data = data or {}
+	headers = headers or {}
+
+	try:
+		response = frappe.flags.integration_request = send_request(
+			gateway,
+			method,
+			url,
+			data=data,
+			auth=auth,
+			headers=headers,
+			json=json,
+			params=params,
+		)
+		response.raise_for_status()
+
+		if content_type := response.headers.get("content-type"):
+			if content_type == "text/plain; charset=utf-8":
+				return parse_qs(response.text)
+			elif content_type.startswith("application/") and content_type.split(";")[0].endswith(
+				"json"
+			):
+				return response.json()
+			elif response.text:
+				return response.text
+		return
+	except Exception as exc:
+		if frappe.flags.integration_request_doc:
+			frappe.flags.integration_request_doc.log_error()
+		frappe.log_error()
+		raise exc
+
+
+def make_get_request(url, **kwargs):
+	return make_request("GET", url, **kwargs)
+
+
+def make_post_request(url, **kwargs):
+	return make_request("POST", url, **kwargs)
@@ -1,3 +1,6 @@
+import copy
+import time
+
 import click
 import frappe
 from frappe import _
@@ -5,29 +8,251 @@ from contextlib import contextmanager
 from frappe.custom.doctype.custom_field.custom_field import create_custom_fields
 
 
+PAYMENT_GATEWAY_CONTROLLER_CACHE = "payment_gateway_controller"
+SETTINGS_VERSION_CACHE = "payment_gateway_settings_version"
+
+# per-process values derived from settings documents, see `get_settings_cache`
+_settings_cache = {}
+
+
 def get_payment_gateway_controller(payment_gateway):
 	"""Return payment gateway controller"""
-	gateway = frappe.get_doc("Payment Gateway", payment_gateway)
+	settings = get_payment_gateway_settings(payment_gateway)
+	if not settings:
+		frappe.throw(_("{0} Settings not found").format(payment_gateway))
+
+	try:
+		# a fresh document, callers keep per-payment state like `data` on the controller
+		return frappe.get_doc(*settings)
+	except Exception:
+		frappe.throw(_("{0} Settings not found").format(payment_gateway))
+
+
+def get_payment_gateway_settings(payment_gateway):
+	"""Return the `(doctype, name)` of the settings document behind a Payment Gateway.
+
+	Resolutions are cached per site, including misses (stored as `False`), and are
+	cleared by `clear_payment_gateway_cache` whenever a gateway or its settings change.
+	"""
+	if not payment_gateway:
+		return False
+
+	return frappe.cache().hget(
+		PAYMENT_GATEWAY_CONTROLLER_CACHE,
+		payment_gateway,
+		lambda: _resolve_payment_gateway_settings(payment_gateway),
+	)
+
+
+def _resolve_payment_gateway_settings(payment_gateway):
+	gateway = frappe.db.get_value(
+		"Payment Gateway",
+		payment_gateway,
+		["gateway_settings", "gateway_controller"],
+		as_dict=True,
+	)
+	if not gateway:
+		return False
+
 	if gateway.gateway_controller is None:
-		try:
-			return frappe.get_doc(f"{payment_gateway} Settings")
-		except Exception:
-			frappe.throw(_("{0} Settings not found").format(payment_gateway))
+		settings = (f"{payment_gateway} Settings", f"{payment_gateway} Settings")
 	else:
-		try:
-			return frappe.get_doc(gateway.gateway_settings, gateway.gateway_controller)
-		except Exception:
-			frappe.throw(_("{0} Settings not found").format(payment_gateway))
+		settings = (gateway.gateway_settings, gateway.gateway_controller)
+
+	try:
+		frappe.get_cached_doc(*settings)
+	except frappe.DoesNotExistError:
+		return False
+
+	return settings
+
+
+def get_reference_gateway_controller(reference_doctype, reference_docname):
+	"""Return the settings name (`gateway_controller`) used by a payment reference, e.g. a Payment Request"""
+	payment_gateway = frappe.db.get_value(reference_doctype, reference_docname, "payment_gateway")
+	settings = get_payment_gateway_settings(payment_gateway)
+	if not settings:
+		return None
+
+	doctype, name = settings
+	return None if doctype == name else name
+
+
+def clear_payment_gateway_cache(doc=None):
+	"""Invalidate cached gateway resolutions; called from the gateway and settings controllers.
+
+	Caches are cleared right away, so the rest of the request sees the new settings, and
+	again after commit: until then, other workers still read the old settings and may
+	have cached them under the new version.
+	"""
+	settings_keys = [get_settings_cache_key("Payment Gateway")]
+	if doc:
+		settings_keys.append(get_settings_cache_key(doc.doctype, doc.name))
+
+	def clear():
+		frappe.cache().delete_value(PAYMENT_GATEWAY_CONTROLLER_CACHE)
+		# the routing capability index covers every gateway, see `payments.utils.routing`
+		for settings_key in settings_keys:
+			frappe.cache().hdel(SETTINGS_VERSION_CACHE, settings_key)
+
+	clear()
+	frappe.db.after_commit.add(clear)
+
+
+def get_settings_cache(doctype, name, key, generator, ttl=None):
+	"""Return a per-process value derived from a settings document.
+
+	The value is built once per worker and reused until the document is saved or
+	deleted again, which changes its version in Redis (see `clear_payment_gateway_cache`),
+	or for at most `ttl` seconds if given.
+	"""
+	settings_key = get_settings_cache_key(doctype, name)
+	version = get_settings_version(doctype, name)
+
+	cache_key = (frappe.local.site, settings_key, key)
+	cached = _settings_cache.get(cache_key)
+	if cached and cached[0] == version and (not ttl or time.monotonic() < cached[2] + ttl):
+		return cached[1]
+
+	value = generator()
+	_settings_cache[cache_key] = (version, value, time.monotonic())
+	return value
+
+
+def get_settings_snapshot(doctype, name=None):
+	"""Return a copy of a settings document, loaded once per worker and reloaded when it is
+	saved (see `get_settings_cache`).
+
+	Attributes set on the copy, like the `data` of a payment request, don't affect other
+	requests, but nested values are shared and the copy must never be saved.
+	"""
+	doc = get_settings_cache(
+		doctype, name, "snapshot", lambda: frappe.get_doc(doctype, name or doctype)
+	)
+
+	snapshot = copy.copy(doc)
+	snapshot.flags = frappe._dict()
+	return snapshot
+
+
+def get_settings_version(doctype, name=None):
+	"""Return a token that changes whenever the settings document is saved or deleted"""
+	return frappe.cache().hget(
+		SETTINGS_VERSION_CACHE, get_settings_cache_key(doctype, name), frappe.generate_hash
+	)
+
+
+def get_settings_cache_key(doctype, name=None):
+	return f"{doctype}::{name or doctype}"
+
+
+def get_payments_config(conf_key, defaults, *sections):
+	"""Return `defaults` updated with the `conf_key` dict of site config, or only with its
+	`sections` (e.g. "default" and a gateway) in order if given"""
+	site_config = frappe.conf.get(conf_key) or {}
+
+	config = frappe._dict(defaults)
+	if not sections:
+		config.update(site_config)
+
+	for section in sections:
+		if section:
+			config.update(site_config.get(section) or {})
+
+	return config
+
+
+def create_request_logs(service_name, logs):
+	"""Insert Integration Request logs for `service_name` in a single query.
+
+	Each log is a dict with `name`, `data` and optionally `error`, `output` and `status`
+	("Queued" by default), like the arguments of `frappe.integrations.utils.create_request_log`.
+	Names that already exist are skipped, so retried requests don't fail on duplicate logs,
+	and logs without a name get a random one.
+	"""
+	if not logs:
+		return
+
+	now = frappe.utils.now()
+	fields = [
+		"name",
+		"creation",
+		"modified",
+		"owner",
+		"modified_by",
+		"docstatus",
+		"integration_request_service",
+		"is_remote_request",
+		"status",
+		"data",
+		"output",
+		"error",
+		"reference_doctype",
+		"reference_docname",
+	]
+
+	from payments.utils.codec import PAYMENTS_SERVICES, encode_payload
+
+	compress = service_name in PAYMENTS_SERVICES
+	values = []
+	for log in logs:
+		# stored with the codec, `PaymentsIntegrationRequest.before_insert` is skipped here
+		log = frappe._dict(log)
+		data = frappe._dict(log.data or {})
+		values.append(
+			(
+				log.name or frappe.generate_hash(length=10),
+				now,
+				now,
+				frappe.session.user,
+				frappe.session.user,
+				0,
+				service_name,
+				0,
+				log.status or "Queued",
+				encode_payload(data, compress),
+				encode_payload(log.output, compress),
+				encode_payload(log.error, compress),
+				data.reference_doctype,
+				data.reference_docname,
+			)
+		)
+
+	frappe.db.bulk_insert("Integration Request", fields, values, ignore_duplicates=True)
 
 
 @frappe.whitelist(allow_guest=True, xss_safe=True)
 def get_checkout_url(**kwargs):
+	from payments.utils.circuit_breaker import GatewayUnavailable
+	from payments.utils.routing import is_routing_enabled, route_payment_gateway
+
 	try:
-		if kwargs.get("payment_gateway"):
+		if kwargs.get("payment_gateway") and is_routing_enabled():
+			kwargs["payment_gateway"] = route_payment_gateway(
+				kwargs.get("amount"),
+				kwargs.get("currency"),
+				default=kwargs["payment_gateway"],
+				reference_doctype=kwargs.get("reference_doctype"),
+				reference_docname=kwargs.get("reference_docname"),
+			)
+			doc = get_payment_gateway_controller(kwargs["payment_gateway"])
+			# the routed gateway, or the default when none is eligible, may be down too
+			check_gateway_availability(doc.doctype.removesuffix(" Settings"), doc.name)
+			return doc.get_payment_url(**kwargs)
+		elif kwargs.get("payment_gateway"):
 			doc = frappe.get_doc("{} Settings".format(kwargs.get("payment_gateway")))
+			# fail fast while the gateway is not responding
+			check_gateway_availability(kwargs.get("payment_gateway"), doc.name)
 			return doc.get_payment_url(**kwargs)
 		else:
 			raise Exception
+	except GatewayUnavailable as e:
+		frappe.respond_as_web_page(
+			_("Something went wrong"),
+			str(e),
+			indicator_color="red",
+			http_status_code=GatewayUnavailable.http_status_code,
+		)
 	except Exception:
 		frappe.respond_as_web_page(
 			_("Something went wrong"),
@@ -39,6 +264,18 @@ def get_checkout_url(**kwargs):
 		)
 
 
+def check_gateway_availability(gateway, account=None):
+	"""Raise `GatewayUnavailable` while the circuit of the gateway account is open"""
+	from payments.utils.circuit_breaker import GatewayUnavailable, is_gateway_available
+
+	if not is_gateway_available(gateway, account):
+		raise GatewayUnavailable(
+			_("{0} is not responding at the moment, please try again in a few minutes").format(
+				gateway
+			)
+		)
+
+
 def create_payment_gateway(gateway, settings=None, controller=None):
 	# NOTE: we don't translate Payment Gateway name because it is an internal doctype
 	if not frappe.db.exists("Payment Gateway", gateway):
@@ -154,6 +391,12 @@ def make_custom_fields():
 
 		create_custom_fields(custom_fields)
 
+		from payments.payment_gateways.doctype.gocardless_mandate.gocardless_mandate import (
+			add_customer_index,
+		)
+
+		add_customer_index()
+
 
 def delete_custom_fields():
 	if frappe.get_meta("Web Form").has_field("payments_tab"):